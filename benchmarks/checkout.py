@@ -0,0 +1,53 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gpgit import base, files
+
+
+def make_repo(count, size):
+    for i in range(count):
+        path = f"d{i % 50}/s{i % 7}/f{i}.txt"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size // 2).hex().encode())
+    base.track(["."])
+    return base.write_tree()
+
+
+def time_checkout(tree, workers):
+    for name in os.listdir("."):
+        if name != ".gpgit":
+            shutil.rmtree(name)
+    with files.get_index() as index:
+        index.clear()
+
+    start = time.perf_counter()
+    base.read_tree(tree, update_working=True, workers=workers)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with files.change_git_dir("."):
+            base.start()
+            tree = make_repo(args.files, args.size)
+            for workers in (1, args.workers):
+                best = min(time_checkout(tree, workers) for _ in range(args.runs))
+                print(f"{workers:>3} workers: {best:.3f}s for {args.files} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from gpgit import base, files, remote, transfer
+
+
+def make_remote(count):
+    os.makedirs("remote")
+    os.chdir("remote")
+    with files.change_git_dir("."):
+        base.start()
+        for i in range(count):
+            path = f"d{i % 20}/f{i}.txt"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"content %d\n" % i)
+        base.track(["."])
+        base.save("benchmark")
+    os.chdir("..")
+
+
+def time_download(jobs):
+    os.makedirs(f"local-{jobs}")
+    with files.change_git_dir(f"local-{jobs}"):
+        base.start()
+        start = time.perf_counter()
+        remote.download("remote", jobs=jobs)
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--objects", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jobs", type=int, default=transfer.MAX_IN_FLIGHT)
+    args = parser.parse_args()
+
+    # Stand-in for a remote on a slow mount: every object copy waits first
+    iter_copy_jobs = files.iter_copy_jobs
+
+    def slow_copy_jobs(objects, to_git_dir, last):
+        for job in iter_copy_jobs(objects, to_git_dir, last):
+            yield transfer.with_latency(job, args.latency)
+
+    files.iter_copy_jobs = slow_copy_jobs
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        make_remote(args.objects)
+        for jobs in (1, args.jobs):
+            elapsed = time_download(jobs)
+            latency = f"{args.latency * 1000:g}ms"
+            print(f"{jobs:>3} in flight: {elapsed:.3f}s at {latency} latency")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RUN = "import sys; from gpgit import gpgit; sys.argv[0] = 'gp-git'; gpgit.main()"
+
+# Import time, in ms, that a plumbing command may spend before and while it
+# runs; about 35-45ms when this was set, against 105-110ms before imports
+# were made lazy. Check it with this benchmark when adding imports
+BUDGET_MS = 50
+
+COMMANDS = [
+    ["fingerprint", "a.txt"],
+    ["view", "HEAD"],
+    ["write-tree"],
+    ["status"],
+]
+
+
+def gp_git(args, importtime=False):
+    flags = ["-X", "importtime"] if importtime else []
+    return subprocess.run(
+        [sys.executable, *flags, "-c", RUN, *args],
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        capture_output=True,
+        check=True,
+    )
+
+
+def import_time(args):
+    # Everything imported from the first gp-git module on: the imports at
+    # startup and the lazy ones made by the command, in ms
+    total = 0
+    started = False
+    for line in gp_git(args, importtime=True).stderr.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        started = started or name.strip().startswith("gpgit")
+        # Nested imports are already counted in their parent's cumulative
+        if started and not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=BUDGET_MS)
+    args = parser.parse_args()
+
+    over = False
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        gp_git(["start"])
+        with open("a.txt", "w") as f:
+            f.write("hello\n")
+        gp_git(["track", "a.txt"])
+        gp_git(["save", "-m", "benchmark"])
+
+        for command in COMMANDS:
+            imports = min(import_time(command) for _ in range(args.runs))
+            wall = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                gp_git(command)
+                wall.append(time.perf_counter() - start)
+            over = over or imports > args.budget
+            print(
+                f"{' '.join(command):<20} imports {imports:6.1f}ms, "
+                f"total {min(wall) * 1000:6.1f}ms"
+            )
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        bare = (time.perf_counter() - start) * 1000
+        print(f"{'(bare python)':<20} total {bare:6.1f}ms")
+
+    if over:
+        print(f"Over the {args.budget}ms import budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
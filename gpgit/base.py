@@ -1,10 +1,15 @@
+import heapq
 import itertools
 import operator
 import os
 import string
 from collections import deque, namedtuple
 from . import files
-from . import compare
+from . import graph
+from .lazy import lazy_import
+
+compare = lazy_import(f"{__package__}.compare")
+futures = lazy_import("concurrent.futures")
 
 
 def start():
@@ -13,46 +18,89 @@ def start():
 
 
 def write_tree():
-    index_as_tree = {}
     with files.get_index() as index:
-        for path, obj_id in index.items():
-            path = path.split("/")
-            dirpath, filename = path[:-1], path[-1]
+        trees = {}
+        obj_id = _tree_from_paths(index, write=True, trees=trees).obj_id
+        index.trees = trees
+        return obj_id
+
+
+# A tree as seen by the tree walkers. `entries` maps name -> (type_, obj_id,
+# node), or is None while the tree is still only known by its stored id
+_TreeNode = namedtuple("_TreeNode", ["obj_id", "entries"])
+_EMPTY_TREE = _TreeNode(None, {})
+# Parsed trees and saves, on top of the raw object cache in files
+_parsed_cache = files.ObjectCache("parsed")
+
+
+def _tree_from_paths(paths, write=False, trees=None):
+    # Directories the index still has a tree id for are not rehashed; they
+    # are left for the tree walkers to read like any stored tree
+    cached = getattr(paths, "trees", {})
+    if trees is None:
+        trees = {}
+    index_as_tree = {}
+    for path, obj_id in paths.items():
+        path = path.split("/")
+        dirpath, filename = path[:-1], path[-1]
+
+        current = index_as_tree
+        for dirname in dirpath:
+            current = current.setdefault(dirname, {})
+        current[filename] = obj_id
+
+    reused = set()
 
-            current = index_as_tree
-            for dirname in dirpath:
-                current = current.setdefault(dirname, {})
-            current[filename] = obj_id
+    def tree_from_dict(tree_dict, dirpath):
+        if dirpath in cached:
+            reused.add(dirpath)
+            trees[dirpath] = cached[dirpath]
+            return _TreeNode(cached[dirpath], None)
 
-    def write_tree_recursive(tree_dict):
-        entries = []
+        entries = {}
         for name, value in tree_dict.items():
             if type(value) is dict:
-                type_ = "tree"
-                obj_id = write_tree_recursive(value)
+                node = tree_from_dict(value, f"{dirpath}/{name}" if dirpath else name)
+                entries[name] = ("tree", node.obj_id, node)
             else:
-                type_ = "blob"
-                obj_id = value
-            entries.append((name, obj_id, type_))
+                entries[name] = ("blob", value, None)
 
         tree = "".join(
-            f"{type_} {obj_id} {name}\n" for name, obj_id, type_ in sorted(entries)
+            f"{type_} {obj_id} {name}\n"
+            for name, (type_, obj_id, _) in sorted(entries.items())
         )
-        return files.fingerprint(tree.encode(), "tree")
-
-    return write_tree_recursive(index_as_tree)
+        trees[dirpath] = files.fingerprint(tree.encode(), "tree", write)
+        return _TreeNode(trees[dirpath], entries)
+
+    node = tree_from_dict(index_as_tree, "")
+    # The subdirectories of a reused directory weren't visited, but nothing
+    # under it changed, so their cached trees still hold
+    if reused:
+        for dirpath, obj_id in cached.items():
+            parent = dirpath
+            while parent and parent not in reused:
+                parent = parent.rpartition("/")[0]
+            if parent in reused:
+                trees[dirpath] = obj_id
+    return node
 
 
 def _iter_tree_entries(obj_id):
     if not obj_id:
         return
-    tree = files.get_object(obj_id, "tree")
-    for entry in tree.decode().splitlines():
-        type_, obj_id, name = entry.split(" ", 2)
-        yield type_, obj_id, name
+    entries = _parsed_cache.get(obj_id)
+    if entries is None:
+        tree = files.get_object(obj_id, "tree")
+        entries = tuple(
+            tuple(entry.split(" ", 2)) for entry in tree.decode().splitlines()
+        )
+        _parsed_cache.put(obj_id, entries, len(tree))
+    yield from entries
 
 
-def get_tree(obj_id, base_path=""):
+def get_tree(obj_id, base_path="", trees=None):
+    if trees is not None and obj_id:
+        trees[base_path.rstrip("/")] = obj_id
     result = {}
     for type_, obj_id, name in _iter_tree_entries(obj_id):
         assert "/" not in name
@@ -61,72 +109,191 @@ def get_tree(obj_id, base_path=""):
         if type_ == "blob":
             result[path] = obj_id
         elif type_ == "tree":
-            result.update(get_tree(obj_id, f"{path}/"))
+            result.update(get_tree(obj_id, f"{path}/", trees))
         else:
             assert False, f"Unknown tree entry {type_}"
     return result
 
 
-def get_working_tree():
-    result = {}
-    for root, _, filenames in os.walk("."):
+def _as_tree_node(tree):
+    # Trees are given as stored tree ids or as flat path -> obj_id dicts, like
+    # the index; the latter are hashed (not stored) so their subtrees have ids
+    if not tree:
+        return _EMPTY_TREE
+    if isinstance(tree, dict):
+        return _tree_from_paths(tree)
+    return _TreeNode(tree, None)
+
+
+def _get_tree_node_entries(node):
+    if node.entries is not None:
+        return node.entries
+    return {
+        name: (type_, obj_id, _TreeNode(obj_id, None) if type_ == "tree" else None)
+        for type_, obj_id, name in _iter_tree_entries(node.obj_id)
+    }
+
+
+def iter_tree_changes(*trees):
+    # Yields (path, *obj_ids) for every path whose blob differs between the
+    # trees, skipping any subtree whose id is the same on all sides
+    nodes = [_as_tree_node(tree) for tree in trees]
+    if any(node.obj_id != nodes[0].obj_id for node in nodes):
+        yield from _iter_tree_node_changes(nodes, "")
+
+
+def _iter_tree_node_changes(nodes, base_path):
+    all_entries = [_get_tree_node_entries(node) for node in nodes]
+    for name in sorted(set().union(*all_entries)):
+        sides = [entries.get(name) for entries in all_entries]
+        obj_ids = [side and side[1] for side in sides]
+        if all(obj_id == obj_ids[0] for obj_id in obj_ids):
+            continue
+
+        path = base_path + name
+        assert "/" not in name
+        assert name not in ("..", ".")
+        blobs = [side[1] if side and side[0] == "blob" else None for side in sides]
+        if any(blob != blobs[0] for blob in blobs):
+            yield (path, *blobs)
+        if any(side and side[0] == "tree" for side in sides):
+            subtrees = [
+                side[2] if side and side[0] == "tree" else _EMPTY_TREE
+                for side in sides
+            ]
+            yield from _iter_tree_node_changes(subtrees, f"{path}/")
+
+
+def _iter_files(dirname):
+    for root, _, filenames in os.walk(dirname):
         for filename in filenames:
             path = os.path.relpath(f"{root}/{filename}")
             if is_ignored(path) or not os.path.isfile(path):
                 continue
-            with open(path, "rb") as f:
-                result[path] = files.fingerprint(f.read())
+            yield path
+
+
+def get_workers():
+    return int(files.get_config("workers", os.cpu_count() or 1))
+
+
+def _thread_pool(workers=None):
+    # Pool threads start with no current repository, give them this one
+    return futures.ThreadPoolExecutor(
+        workers or get_workers(),
+        initializer=files.use_git_dir,
+        initargs=(files.get_git_dir(),),
+    )
+
+
+def _fingerprint_paths(index, paths, write=True, workers=None):
+    # Walk and stat in this thread while a pool reads and hashes the files
+    # whose stat data changed; hashlib, zlib and file I/O release the GIL
+    entries = []
+    with _thread_pool(workers) as executor:
+        for path in paths:
+            # Stat before reading, so a write racing with the read leaves a
+            # stat record that won't match next time
+            stat = files.stat_path(path)
+            obj_id = index.get_cached_obj_id(path, stat)
+            # A cached id may come from a hash-only scan that never stored it
+            if obj_id is None or (write and not files.object_exists(obj_id)):
+                future = executor.submit(files.fingerprint_file, path, write=write)
+                entries.append((path, stat, future))
+            else:
+                entries.append((path, stat, obj_id))
+
+        result = {}
+        for path, stat, obj_id in entries:
+            if not isinstance(obj_id, str):
+                obj_id = obj_id.result()
+                index.update_stat(path, obj_id, stat)
+            result[path] = obj_id
     return result
 
 
-def get_index_tree():
+def get_working_tree(workers=None):
     with files.get_index() as index:
-        return index
+        return _fingerprint_paths(index, _iter_files("."), False, workers)
 
 
-def _empty_current_directory():
-    for root, dirnames, filenames in os.walk(".", topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f"{root}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(f"{root}/{dirname}")
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except OSError:
-                pass
+def get_index_tree():
+    with files.read_index() as index:
+        return index.load() if isinstance(index, files.IndexView) else index
 
 
-def read_tree(tree_obj_id, update_working=False):
+def read_tree(tree_obj_id, update_working=False, workers=None, progress=None):
     with files.get_index() as index:
+        old_index = files.Index(index, trees=dict(index.trees))
         index.clear()
-        index.update(get_tree(tree_obj_id))
+        trees = {}
+        index.update(get_tree(tree_obj_id, trees=trees))
+        index.trees = trees
 
         if update_working:
-            _switch_index(index)
+            _switch_index(old_index, index, workers, progress)
 
 
 def read_tree_combined(t_base, t_HEAD, t_other, update_working=False):
     with files.get_index() as index:
+        old_index = files.Index(index, trees=dict(index.trees))
         index.clear()
-        index.update(
-            compare.combine_trees(get_tree(t_base), get_tree(t_HEAD), get_tree(t_other))
-        )
+        trees = {}
+        index.update(get_tree(t_HEAD, trees=trees))
+        index.trees = trees
+        changes = iter_tree_changes(t_base, t_HEAD, t_other)
+        for path, obj_id in compare.combine_trees(changes).items():
+            if obj_id:
+                index[path] = obj_id
+            else:
+                index.pop(path, None)
 
         if update_working:
-            _switch_index(index)
+            _switch_index(old_index, index)
 
 
-def _switch_index(index):
-    _empty_current_directory()
-    for path, obj_id in index.items():
-        os.makedirs(os.path.dirname(f"./{path}"), exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(files.get_object(obj_id, "blob"))
+def _switch_index(old_index, index, workers=None, progress=None):
+    # Only paths whose obj_id changed are touched; untracked files and
+    # unchanged files, with their mtimes, are left as they are
+    changes = list(iter_tree_changes(old_index, index))
+    for path, _, obj_id in changes:
+        if obj_id is None and os.path.isfile(path):
+            os.remove(path)
+            _remove_empty_dirs(os.path.dirname(path))
+
+    # Blobs are decompressed and written on a pool, but results are taken in
+    # path order, so progress and the first error reported don't depend on
+    # thread timing
+    changes = [(path, obj_id) for path, _, obj_id in changes if obj_id is not None]
+    # Blobs a partial download left on the remote come in one batch
+    files.fetch_objects(obj_id for _, obj_id in changes)
+    for dirname in sorted({os.path.dirname(path) for path, _ in changes}):
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+    with _thread_pool(workers) as executor:
+        futures = [
+            (path, obj_id, executor.submit(_checkout_file, path, obj_id))
+            for path, obj_id in changes
+        ]
+        for done, (path, obj_id, future) in enumerate(futures, 1):
+            index.update_stat(path, obj_id, future.result())
+            if progress:
+                progress(done, len(futures))
+
+
+def _checkout_file(path, obj_id):
+    with open(path, "wb") as f:
+        files.copy_object(obj_id, f, "blob")
+    return files.stat_path(path)
+
+
+def _remove_empty_dirs(dirname):
+    while dirname:
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            return
+        dirname = os.path.dirname(dirname)
 
 
 def save(message):
@@ -143,14 +310,15 @@ def save(message):
     save += f"{message}\n"
 
     obj_id = files.fingerprint(save.encode(), "save")
+    get_graph_entry(obj_id)
     files.update_ref("HEAD", files.RefValue(symbolic=False, value=obj_id))
     return obj_id
 
 
-def switch(name):
+def switch(name, workers=None, progress=None):
     obj_id = get_obj_id(name)
     save = get_save(obj_id)
-    read_tree(save.tree, update_working=True)
+    read_tree(save.tree, update_working=True, workers=workers, progress=progress)
 
     if is_branch(name):
         HEAD = files.RefValue(symbolic=True, value=f"refs/heads/{name}")
@@ -185,15 +353,67 @@ def combine(other):
 
 
 def get_combine_base(obj_id1, obj_id2):
-    parents1 = set(iter_saves_and_parents({obj_id1}))
-
-    for obj_id in iter_saves_and_parents({obj_id2}):
-        if obj_id in parents1:
+    # Walk down from both sides, highest generation first, marking what each
+    # side reaches. Every child of a save has a higher generation, so by the
+    # time a save comes up its marks are final and the first one marked by
+    # both sides is a common ancestor that no other common ancestor descends
+    # from
+    reached = {obj_id1: 1}
+    reached[obj_id2] = reached.get(obj_id2, 0) | 2
+    queue = [(-get_graph_entry(obj_id).generation, obj_id) for obj_id in reached]
+    heapq.heapify(queue)
+
+    while queue:
+        _, obj_id = heapq.heappop(queue)
+        sides = reached[obj_id]
+        if sides == 3:
             return obj_id
+        for parent in get_graph_entry(obj_id).parents:
+            if parent not in reached:
+                heapq.heappush(queue, (-get_graph_entry(parent).generation, parent))
+            reached[parent] = reached.get(parent, 0) | sides
 
 
 def is_ancestor_of(save, maybe_ancestor):
-    return maybe_ancestor in iter_saves_and_parents({save})
+    if not graph.get_entry(maybe_ancestor) and not files.object_exists(maybe_ancestor):
+        return False
+    # Nothing below the ancestor's generation can lead back up to it
+    generation = get_graph_entry(maybe_ancestor).generation
+    obj_ids = [save]
+    visited = set()
+    while obj_ids:
+        obj_id = obj_ids.pop()
+        if obj_id == maybe_ancestor:
+            return True
+        if obj_id in visited:
+            continue
+        visited.add(obj_id)
+        entry = get_graph_entry(obj_id)
+        if entry.generation > generation:
+            obj_ids.extend(entry.parents)
+    return False
+
+
+def reachable_from(obj_ids):
+    # A has_save for saves the given ones lead back to. Their history is
+    # walked once, highest generation first, and only as far down as the
+    # saves asked about: nothing below a generation leads back up to it
+    queue = [(-get_graph_entry(obj_id).generation, obj_id) for obj_id in obj_ids]
+    heapq.heapify(queue)
+    reached = set()
+
+    def has_save(obj_id):
+        generation = get_graph_entry(obj_id).generation
+        while queue and -queue[0][0] >= generation:
+            _, current = heapq.heappop(queue)
+            if current in reached:
+                continue
+            reached.add(current)
+            for parent in get_graph_entry(current).parents:
+                heapq.heappush(queue, (-get_graph_entry(parent).generation, parent))
+        return obj_id in reached
+
+    return has_save
 
 
 def create_label(name, obj_id):
@@ -226,6 +446,9 @@ _save = namedtuple("_save", ["tree", "parents", "message"])
 
 
 def get_save(obj_id):
+    cached = _parsed_cache.get(obj_id)
+    if cached is not None:
+        return cached
     parents = []
 
     save = files.get_object(obj_id, "save").decode()
@@ -240,7 +463,96 @@ def get_save(obj_id):
             assert False, f"Unknown field {key}"
 
     message = "\n".join(lines)
-    return _save(tree=tree, parents=parents, message=message)
+    cached = _save(tree=tree, parents=tuple(parents), message=message)
+    _parsed_cache.put(obj_id, cached, len(save))
+    return cached
+
+
+def get_graph_entry(obj_id):
+    entry = graph.get_entry(obj_id)
+    if entry:
+        return entry
+
+    # Saves from before the commit graph, or fetched from a remote, are added
+    # the first time they are looked up, after all of their ancestors
+    new_entries = {}
+    saves = {}
+    # Saves at the edge of a shallow download have parents that were never
+    # fetched, so they go in as the first saves of their history, until a
+    # download brings the parents, see update_shallow
+    shallow = files.get_shallow()
+    stack = [obj_id]
+    while stack:
+        current = stack[-1]
+        if current in new_entries or graph.get_entry(current):
+            stack.pop()
+            continue
+        if current not in saves:
+            save = get_save(current)
+            if current in shallow:
+                save = save._replace(parents=())
+            saves[current] = save
+        save = saves[current]
+        missing = [
+            parent
+            for parent in save.parents
+            if parent not in new_entries and not graph.get_entry(parent)
+        ]
+        if missing:
+            stack.extend(missing)
+            continue
+
+        stack.pop()
+        generation = 1 + max(
+            (
+                (new_entries.get(parent) or graph.get_entry(parent)).generation
+                for parent in save.parents
+            ),
+            default=0,
+        )
+        new_entries[current] = graph.GraphEntry(save.tree, save.parents, generation)
+
+    graph.add_entries(new_entries)
+    return new_entries[obj_id]
+
+
+def has_full_history(obj_id):
+    # Whether a save and every save before it are here, for a download to
+    # stop at. A save in the shallow file has its parents missing, and so
+    # does one an interrupted download left behind; neither counts, so the
+    # next download fills them in. A commit graph entry stands for a whole
+    # history only while nothing is shallow, as saves after a shallow one
+    # have entries too
+    shallow = files.get_shallow()
+    stack = [obj_id]
+    visited = set()
+    while stack:
+        current = stack.pop()
+        if current in shallow:
+            return False
+        if current in visited or (not shallow and graph.get_entry(current)):
+            continue
+        visited.add(current)
+        if not files.object_exists(current):
+            return False
+        stack.extend(get_save(current).parents)
+    get_graph_entry(obj_id)
+    return True
+
+
+def update_shallow(new_shallow=()):
+    # After a download: saves whose parents it left out join the shallow
+    # file, and those whose parents are all here now leave it, along with
+    # the graph entries that were made while they had none
+    old = files.get_shallow()
+    shallow = {
+        obj_id
+        for obj_id in old | set(new_shallow)
+        if not all(files.object_exists(parent) for parent in get_save(obj_id).parents)
+    }
+    if shallow != old:
+        files.set_shallow(shallow)
+        graph.remove_entries(old - shallow)
 
 
 def iter_saves_and_parents(obj_ids):
@@ -254,30 +566,105 @@ def iter_saves_and_parents(obj_ids):
         visited.add(obj_id)
         yield obj_id
 
-        save = get_save(obj_id)
-        obj_ids.extendleft(save.parents[:1])
-        obj_ids.extend(save.parents[1:])
+        parents = get_graph_entry(obj_id).parents
+        obj_ids.extendleft(parents[:1])
+        obj_ids.extend(parents[1:])
 
 
-def iter_objects_in_saves(obj_ids):
+def _iter_typed_objects_in_saves(obj_ids):
     visited = set()
 
-    def iter_objects_in_tree(obj_id):
+    def iter_objects_in_tree(obj_id, name=""):
         visited.add(obj_id)
-        yield obj_id
-        for type_, obj_id, _ in _iter_tree_entries(obj_id):
+        yield "tree", obj_id, name
+        for type_, obj_id, name in _iter_tree_entries(obj_id):
             if obj_id not in visited:
                 if type_ == "tree":
-                    yield from iter_objects_in_tree(obj_id)
+                    yield from iter_objects_in_tree(obj_id, name)
                 else:
                     visited.add(obj_id)
-                    yield obj_id
+                    yield type_, obj_id, name
 
     for obj_id in iter_saves_and_parents(obj_ids):
+        yield "save", obj_id, ""
+        tree = get_graph_entry(obj_id).tree
+        if tree not in visited:
+            yield from iter_objects_in_tree(tree)
+
+
+def iter_objects_in_saves(obj_ids):
+    for _, obj_id, _ in _iter_typed_objects_in_saves(obj_ids):
         yield obj_id
-        save = get_save(obj_id)
-        if save.tree not in visited:
-            yield from iter_objects_in_tree(save.tree)
+
+
+def iter_new_objects(obj_ids, has_save, depth=None, shallow=None, blobs=True):
+    # The objects another repository needs for the saves obj_ids, given
+    # has_save to ask it about saves. Saves are walked from the tips down to
+    # the ones it has, and of each new save only the paths that differ from
+    # its parents. Objects come before anything that refers to them, so the
+    # whole walk is done before the first one comes. With a depth, the walk stops that many saves below the tips, and the
+    # saves whose parents are left out are added to the shallow set. Without
+    # blobs, only saves and trees are sent
+    new_saves = []
+    sent = set()
+    obj_ids = deque((obj_id, 1) for obj_id in obj_ids)
+    visited = set()
+    while obj_ids:
+        # Breadth first, so each save is reached at its lowest depth
+        obj_id, save_depth = obj_ids.popleft()
+        if obj_id in visited:
+            continue
+        visited.add(obj_id)
+        if has_save(obj_id):
+            continue
+        entry = get_graph_entry(obj_id)
+        boundary = depth is not None and save_depth >= depth and entry.parents
+        if boundary:
+            if shallow is not None:
+                shallow.add(obj_id)
+            # The other repository gets the whole tree, nothing to diff against
+            entry = entry._replace(parents=())
+        new_saves.append((entry.generation, obj_id, entry))
+        obj_ids.extend((parent, save_depth + 1) for parent in entry.parents)
+
+    for _, obj_id, entry in sorted(new_saves):
+        yield from _iter_new_save_objects(obj_id, entry, sent, blobs)
+
+
+def _iter_new_save_objects(obj_id, entry, sent, blobs=True):
+    parent_trees = [get_graph_entry(parent).tree for parent in entry.parents]
+    yield from _iter_new_tree_objects(entry.tree, parent_trees, sent, "", blobs)
+    yield "save", obj_id, ""
+
+
+def _iter_new_tree_objects(obj_id, parent_trees, sent, name, blobs=True):
+    if obj_id in sent or obj_id in parent_trees:
+        return
+    sent.add(obj_id)
+
+    parent_entries = {}
+    for parent_tree in parent_trees:
+        for type_, entry_id, entry_name in _iter_tree_entries(parent_tree):
+            parent_entries.setdefault(entry_name, []).append((type_, entry_id))
+
+    for type_, entry_id, entry_name in _iter_tree_entries(obj_id):
+        known = parent_entries.get(entry_name, [])
+        if entry_id in sent or (type_, entry_id) in known:
+            continue
+        if type_ == "tree":
+            subtrees = [tree_id for kind, tree_id in known if kind == "tree"]
+            yield from _iter_new_tree_objects(
+                entry_id, subtrees, sent, entry_name, blobs
+            )
+        elif blobs:
+            sent.add(entry_id)
+            yield type_, entry_id, entry_name
+    yield "tree", obj_id, name
+
+
+def pack_objects(gc=False):
+    saves = {ref.value for _, ref in files.iter_refs()}
+    return files.pack_objects(_iter_typed_objects_in_saves(saves), gc)
 
 
 def get_obj_id(name):
@@ -301,28 +688,17 @@ def get_obj_id(name):
     assert False, f"Unknown name {name}"
 
 
-def track(filenames):
-
-    def track_file(filename):
-        filename = os.path.relpath(filename)
-        with open(filename, "rb") as f:
-            obj_id = files.fingerprint(f.read())
-        index[filename] = obj_id
+def track(filenames, workers=None):
 
-    def track_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                path = os.path.relpath(f"{root}/{filename}")
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                track_file(path)
-
-    with files.get_index() as index:
+    def iter_paths():
         for name in filenames:
             if os.path.isfile(name):
-                track_file(name)
+                yield os.path.relpath(name)
             elif os.path.isdir(name):
-                track_directory(name)
+                yield from _iter_files(name)
+
+    with files.get_index() as index:
+        index.update(_fingerprint_paths(index, iter_paths(), workers=workers))
 
 
 def is_ignored(path):
@@ -1,7 +1,8 @@
-import subprocess
 from collections import defaultdict
-from tempfile import NamedTemporaryFile as Temp
 from . import files
+from .lazy import lazy_import
+
+futures = lazy_import("concurrent.futures")
 
 
 def compare_trees(*trees):
@@ -14,79 +15,317 @@ def compare_trees(*trees):
         yield (path, *obj_ids)
 
 
-def iter_changed_files(t_from, t_to):
-    for path, o_from, o_to in compare_trees(t_from, t_to):
+def iter_changed_files(changes):
+    for path, o_from, o_to in changes:
         if o_from != o_to:
             action = "new file" if not o_from else "deleted" if not o_to else "modified"
             yield path, action
 
 
-def comp_trees(t_from, t_to):
-    output = b""
-    for path, o_from, o_to in compare_trees(t_from, t_to):
-        if o_from != o_to:
-            output += compare_blobs(o_from, o_to, path)
-    return output
-
-
-def compare_blobs(o_from, o_to, path="blob"):
-    with Temp() as f_from, Temp() as f_to:
-        for obj_id, f in ((o_from, f_from), (o_to, f_to)):
-            if obj_id:
-                f.write(files.get_object(obj_id))
-                f.flush()
-
-        with subprocess.Popen(
-            [
-                "diff",
-                "--unified",
-                "--show-c-function",
-                "--label",
-                f"a/{path}",
-                f_from.name,
-                "--label",
-                f"b/{path}",
-                f_to.name,
-            ],
-            stdout=subprocess.PIPE,
-        ) as proc:
-            output, _ = proc.communicate()
-
-        return output
-
-
-def combine_trees(t_base, t_HEAD, t_other):
-    tree = {}
-    for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_HEAD, t_other):
-        tree[path] = files.fingerprint(combine_blobs(o_base, o_HEAD, o_other))
-    return tree
+CONTEXT_LINES = 3
+# Below this many changed files the process pool costs more than it saves
+POOL_MIN_CHANGES = 256
+
+
+def comp_trees(changes, working=False, workers=1):
+    changes = [
+        (o_from, o_to, path, working)
+        for path, o_from, o_to in changes
+        if o_from != o_to
+    ]
+    # Working tree ids aren't stored anywhere, the files are read instead
+    files.fetch_objects(
+        obj_id
+        for o_from, o_to, _, working in changes
+        for obj_id in (o_from, None if working else o_to)
+        if obj_id
+    )
+    if workers <= 1 or len(changes) < POOL_MIN_CHANGES:
+        for change in changes:
+            yield compare_blobs(*change)
+        return
+
+    with futures.ProcessPoolExecutor(
+        workers, initializer=files.use_git_dir, initargs=(files.get_git_dir(),)
+    ) as executor:
+        yield from executor.map(_compare_change, changes, chunksize=32)
+
+
+def _compare_change(change):
+    return compare_blobs(*change)
+
+
+def _read_blob(obj_id, path=None):
+    # Working tree blobs are only hashed, never stored, so read them from disk
+    if path is not None:
+        with open(path, "rb") as f:
+            return f.read()
+    return files.get_object(obj_id)
+
+
+def compare_blobs(o_from, o_to, path="blob", working=False):
+    data_from = _read_blob(o_from) if o_from else b""
+    data_to = _read_blob(o_to, path if working else None) if o_to else b""
+    if b"\x00" in data_from[:8000] or b"\x00" in data_to[:8000]:
+        return f"Binary files a/{path} and b/{path} differ\n".encode()
+
+    a = data_from.splitlines(keepends=True)
+    b = data_to.splitlines(keepends=True)
+    output = [f"--- a/{path}\n+++ b/{path}\n".encode()]
+    function = _FunctionContext(a)
+    for hunk in _iter_hunks(_iter_opcodes(a, b)):
+        a_start, a_end = hunk[0][1], hunk[-1][2]
+        b_start, b_end = hunk[0][3], hunk[-1][4]
+        ranges = f"-{_format_range(a_start, a_end)} +{_format_range(b_start, b_end)}"
+        output.append(f"@@ {ranges} @@".encode() + function.find(a_start) + b"\n")
+        for tag, i1, i2, j1, j2 in hunk:
+            if tag == "equal":
+                output.extend(_format_lines(b" ", a[i1:i2]))
+                continue
+            output.extend(_format_lines(b"-", a[i1:i2]))
+            output.extend(_format_lines(b"+", b[j1:j2]))
+    return b"".join(output) if len(output) > 1 else b""
+
+
+def _format_range(start, end):
+    length = end - start
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1 if length else start},{length}"
+
+
+def _format_lines(prefix, lines):
+    for line in lines:
+        yield prefix + line
+        if not line.endswith(b"\n"):
+            yield b"\n\\ No newline at end of file\n"
+
+
+class _FunctionContext:
+    # Like diff --show-c-function: the last line before the hunk that starts
+    # with a letter, `_` or `$`, cut to 40 bytes
+    def __init__(self, lines):
+        self.lines = lines
+        self.scanned = 0
+        self.last = b""
+
+    def find(self, start):
+        for line in self.lines[self.scanned : start]:
+            if line[:1].isalpha() or line[:1] in (b"_", b"$"):
+                self.last = b" " + line.rstrip(b"\r\n")[:40].rstrip()
+        self.scanned = max(self.scanned, start)
+        return self.last
+
+
+def _iter_hunks(opcodes):
+    # Group the edit script into hunks, keeping CONTEXT_LINES of unchanged
+    # lines around each change and merging changes whose context overlaps
+    hunk = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != "equal":
+            hunk.append((tag, i1, i2, j1, j2))
+            continue
+
+        if hunk:
+            if i2 - i1 <= 2 * CONTEXT_LINES:
+                hunk.append((tag, i1, i2, j1, j2))
+                continue
+            n = CONTEXT_LINES
+            hunk.append((tag, i1, i1 + n, j1, j1 + n))
+            yield hunk
+        n = min(CONTEXT_LINES, i2 - i1)
+        hunk = [(tag, i2 - n, i2, j2 - n, j2)] if n else []
+
+    if any(tag != "equal" for tag, *_ in hunk):
+        while hunk[-1][0] == "equal" and hunk[-1][2] - hunk[-1][1] > CONTEXT_LINES:
+            tag, i1, i2, j1, j2 = hunk.pop()
+            hunk.append((tag, i1, i1 + CONTEXT_LINES, j1, j1 + CONTEXT_LINES))
+        yield hunk
+
+
+def _iter_opcodes(a, b):
+    # Turn the matched line pairs into difflib-style (tag, i1, i2, j1, j2)
+    i = j = 0
+    for a_match, b_match, length in _iter_matching_blocks(a, b):
+        if i < a_match or j < b_match:
+            yield ("replace", i, a_match, j, b_match)
+        if length:
+            yield ("equal", a_match, a_match + length, b_match, b_match + length)
+        i, j = a_match + length, b_match + length
+
+
+def _iter_matching_blocks(a, b):
+    pairs = []
+    _match_lines(a, b, 0, len(a), 0, len(b), pairs)
+
+    start = None
+    for i, j in pairs:
+        if start and i == start[0] + length and j == start[1] + length:
+            length += 1
+            continue
+        if start:
+            yield start[0], start[1], length
+        start, length = (i, j), 1
+    if start:
+        yield start[0], start[1], length
+    yield len(a), len(b), 0
+
+
+def _match_lines(a, b, a_lo, a_hi, b_lo, b_hi, pairs):
+    # Myers' linear-space diff: strip the common prefix and suffix, split
+    # the rest at the middle snake and recurse on both halves
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        pairs.append((a_lo, b_lo))
+        a_lo, b_lo = a_lo + 1, b_lo + 1
+    suffix = []
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi, b_hi = a_hi - 1, b_hi - 1
+        suffix.append((a_hi, b_hi))
+
+    if a_lo < a_hi and b_lo < b_hi:
+        split = _middle_snake(a, b, a_lo, a_hi, b_lo, b_hi)
+        if split:
+            x, y = split
+            _match_lines(a, b, a_lo, x, b_lo, y, pairs)
+            _match_lines(a, b, x, a_hi, y, b_hi, pairs)
+    pairs.extend(reversed(suffix))
+
+
+def _middle_snake(a, b, a_lo, a_hi, b_lo, b_hi):
+    n, m = a_hi - a_lo, b_hi - b_lo
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    v_forward = [-1] * (2 * max_d + 2)
+    v_backward = [-1] * (2 * max_d + 2)
+    v_forward[offset + 1] = v_backward[offset + 1] = 0
+    delta = n - m
+    # When delta is odd the paths can only meet on a forward step
+    front = delta % 2 != 0
+    k1_start = k1_end = k2_start = k2_end = 0
+
+    for d in range(max_d):
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (
+                k1 != d and v_forward[k1_offset - 1] < v_forward[k1_offset + 1]
+            ):
+                x1 = v_forward[k1_offset + 1]
+            else:
+                x1 = v_forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[a_lo + x1] == b[b_lo + y1]:
+                x1, y1 = x1 + 1, y1 + 1
+            v_forward[k1_offset] = x1
+            if x1 > n:
+                k1_end += 2
+            elif y1 > m:
+                k1_start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < len(v_backward) and v_backward[k2_offset] != -1:
+                    if x1 >= n - v_backward[k2_offset]:
+                        return a_lo + x1, b_lo + y1
+
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (
+                k2 != d and v_backward[k2_offset - 1] < v_backward[k2_offset + 1]
+            ):
+                x2 = v_backward[k2_offset + 1]
+            else:
+                x2 = v_backward[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[a_hi - x2 - 1] == b[b_hi - y2 - 1]:
+                x2, y2 = x2 + 1, y2 + 1
+            v_backward[k2_offset] = x2
+            if x2 > n:
+                k2_end += 2
+            elif y2 > m:
+                k2_start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < len(v_forward) and v_forward[k1_offset] != -1:
+                    x1 = v_forward[k1_offset]
+                    y1 = offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return a_lo + x1, b_lo + y1
+    return None
+
+
+def combine_trees(changes):
+    # Takes (path, o_base, o_HEAD, o_other) tuples, gives the combined id of
+    # each path, None where it ends up deleted
+    return {
+        path: combine_obj_ids(o_base, o_HEAD, o_other)
+        for path, o_base, o_HEAD, o_other in changes
+    }
+
+
+def combine_obj_ids(o_base, o_HEAD, o_other):
+    # Same change on both sides, or a change on one side only: the ids alone
+    # decide. None means the path is deleted
+    if o_HEAD == o_other or o_base == o_other:
+        return o_HEAD
+    if o_base == o_HEAD:
+        return o_other
+    return files.fingerprint(combine_blobs(o_base, o_HEAD, o_other))
 
 
 def combine_blobs(o_base, o_HEAD, o_other):
-    with Temp() as f_base, Temp() as f_HEAD, Temp() as f_other:
-
-        for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
-            if oid:
-                f.write(files.get_object(oid))
-                f.flush()
-
-        with subprocess.Popen(
-            [
-                "compare3",
-                "-m",
-                "-L",
-                "HEAD",
-                f_HEAD.name,
-                "-L",
-                "BASE",
-                f_base.name,
-                "-L",
-                "COMBINE_HEAD",
-                f_other.name,
-            ],
-            stdout=subprocess.PIPE,
-        ) as proc:
-            output, _ = proc.communicate()
-            assert proc.returncode in (0, 1)
-
-        return output
+    base, HEAD, other = (
+        files.get_object(obj_id).splitlines(keepends=True) if obj_id else []
+        for obj_id in (o_base, o_HEAD, o_other)
+    )
+
+    HEAD_matches = _match_map(base, HEAD)
+    other_matches = _match_map(base, other)
+    output = []
+    i_base = i_HEAD = i_other = 0
+    # Lines of base kept by both sides are stable, everything between two
+    # stable lines is a chunk that at most one side may have changed
+    for i in range(len(base) + 1):
+        if i < len(base) and (i not in HEAD_matches or i not in other_matches):
+            continue
+        end_HEAD = HEAD_matches[i] if i < len(base) else len(HEAD)
+        end_other = other_matches[i] if i < len(base) else len(other)
+        output.extend(
+            _combine_chunk(
+                base[i_base:i], HEAD[i_HEAD:end_HEAD], other[i_other:end_other]
+            )
+        )
+        if i < len(base):
+            output.append(base[i])
+        i_base, i_HEAD, i_other = i + 1, end_HEAD + 1, end_other + 1
+
+    return b"".join(output)
+
+
+def _match_map(a, b):
+    matches = {}
+    for i, j, length in _iter_matching_blocks(a, b):
+        for k in range(length):
+            matches[i + k] = j + k
+    return matches
+
+
+def _combine_chunk(base, HEAD, other):
+    if HEAD == base or HEAD == other:
+        return other
+    if other == base:
+        return HEAD
+
+    return [
+        b"<<<<<<< HEAD\n",
+        *_ensure_newline(HEAD),
+        b"||||||| BASE\n",
+        *_ensure_newline(base),
+        b"=======\n",
+        *_ensure_newline(other),
+        b">>>>>>> COMBINE_HEAD\n",
+    ]
+
+
+def _ensure_newline(lines):
+    if lines and not lines[-1].endswith(b"\n"):
+        return lines[:-1] + [lines[-1] + b"\n"]
+    return lines
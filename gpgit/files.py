@@ -1,31 +1,182 @@
 import os
+import re
 import json
-import shutil
+import contextvars
+import functools
 import hashlib
-from collections import namedtuple
+import mmap
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
 from contextlib import contextmanager
+from . import pack
+from .lazy import lazy_import
 
-GPGIT_DIR = None
+# Only needed for writes and transfers, and slow to import
+protocol = lazy_import(f"{__package__}.protocol")
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, which has no FICLONE either
+    fcntl = None
+
+CHUNK_SIZE = 1 << 20
+# Stored objects are never uncompressed objects, whose first byte is the
+# start of their type name
+ZLIB_MAGIC = b"\x78"
+# Per cache, in bytes of object content; 0 turns caching off
+CACHE_SIZE = 32 << 20
+
+
+# The current repository's .gpgit directory. It is kept per thread and
+# asyncio task rather than in a module global, so threads can each work on
+# a repository of their own; new threads start without one, see use_git_dir
+_git_dir = contextvars.ContextVar("git_dir", default=None)
+
+
+def get_git_dir():
+    return _git_dir.get()
+
+
+def use_git_dir(git_dir):
+    # For pool initializers: makes git_dir current for the rest of the thread
+    _git_dir.set(git_dir)
+
+
+def __getattr__(name):
+    # files.GPGIT_DIR still reads the current repository's directory
+    if name == "GPGIT_DIR":
+        return _git_dir.get()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @contextmanager
 def change_git_dir(new_dir):
-    global GPGIT_DIR
-    old_dir = GPGIT_DIR
-    GPGIT_DIR = f"{new_dir}/.gpgit"
-    yield
-    GPGIT_DIR = old_dir
+    token = _git_dir.set(f"{new_dir}/.gpgit")
+    try:
+        yield
+    finally:
+        _git_dir.reset(token)
 
 
 def start():
-    os.makedirs(GPGIT_DIR)
-    os.makedirs(f"{GPGIT_DIR}/objects")
+    os.makedirs(get_git_dir())
+    os.makedirs(f"{get_git_dir()}/objects")
+
+
+# Parsed configs by path, reread when the file changes; every object
+# written looks up the compression level
+_configs = {}
+
+
+def _read_config():
+    config_path = f"{get_git_dir()}/config"
+    try:
+        st = os.stat(config_path)
+    except FileNotFoundError:
+        return {}
+    key = os.path.abspath(config_path)
+    cached = _configs.get(key)
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size, st.st_ino):
+        return cached[1]
+
+    with open(config_path) as f:
+        config = json.load(f)
+    _configs[key] = ((st.st_mtime_ns, st.st_size, st.st_ino), config)
+    return config
+
+
+def get_config(key, default=None):
+    return _read_config().get(key, default)
+
+
+def set_config(key, value):
+    config_path = f"{get_git_dir()}/config"
+    config = dict(_read_config())
+    config[key] = value
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=2)
+    # The mtime may not have ticked, don't rely on it
+    _configs.pop(os.path.abspath(config_path), None)
 
 
 RefValue = namedtuple("RefValue", ["symbolic", "value"])
 
+LOCK_TIMEOUT = 5
+# .gpgit/packed-refs: one "<obj_id> <refname>" line per ref, sorted by name.
+# A loose ref file takes precedence over the packed value of the same ref
+_packed_refs = {}
+
+
+@contextmanager
+def _lock(path):
+    # Whoever creates <path>.lock owns the file until it is renamed over it
+    lock_path = f"{path}.lock"
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            break
+        except FileExistsError:
+            assert time.monotonic() < deadline, f"Unable to lock {path}"
+            time.sleep(0.01)
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+    except BaseException:
+        os.remove(lock_path)
+        raise
+
 
-def update_ref(ref, value, deref=True):
+def make_temp_file(dir, prefix="tmp-"):
+    # Like tempfile.mkstemp, but with the mode a plain open() would give, so
+    # objects, packs and the index stay readable as the umask allows
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        tmp_path = f"{dir}/{prefix}{os.urandom(8).hex()}"
+        try:
+            return os.open(tmp_path, flags, 0o666), tmp_path
+        except FileExistsError:
+            pass
+
+
+def _commit_lock(path):
+    os.replace(f"{path}.lock", path)
+
+
+def _read_packed_refs():
+    packed_path = f"{get_git_dir()}/packed-refs"
+    try:
+        st = os.stat(packed_path)
+    except FileNotFoundError:
+        return {}
+    key = os.path.abspath(packed_path)
+    cached = _packed_refs.get(key)
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size, st.st_ino):
+        return cached[1]
+
+    refs = {}
+    with open(packed_path) as f:
+        for line in f:
+            value, refname = line.rstrip("\n").split(" ", 1)
+            refs[refname] = value
+    _packed_refs[key] = ((st.st_mtime_ns, st.st_size, st.st_ino), refs)
+    return refs
+
+
+def _write_packed_refs(f, refs):
+    f.writelines(f"{value} {refname}\n" for refname, value in sorted(refs.items()))
+
+
+def update_ref(ref, value, deref=True, expected_old=None):
+    # With expected_old, the update only happens if the ref still has that
+    # value ("" for a ref that doesn't exist yet)
     ref = _get_ref_internal(ref, deref)[0]
 
     assert value.value
@@ -34,10 +185,13 @@ def update_ref(ref, value, deref=True):
     else:
         value = value.value
 
-    ref_path = f"{GPGIT_DIR}/{ref}"
-    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-    with open(ref_path, "w") as f:
+    ref_path = f"{get_git_dir()}/{ref}"
+    with _lock(ref_path) as f:
+        if expected_old is not None:
+            old = _get_ref_internal(ref, deref=False)[1].value or ""
+            assert old == expected_old, f"{ref} moved to {old or 'nothing'}"
         f.write(value)
+    _commit_lock(ref_path)
 
 
 def get_ref(ref, deref=True):
@@ -46,15 +200,29 @@ def get_ref(ref, deref=True):
 
 def delete_ref(ref, deref=True):
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f"{GPGIT_DIR}/{ref}")
+    ref_path = f"{get_git_dir()}/{ref}"
+    with _lock(ref_path):
+        if os.path.isfile(ref_path):
+            os.remove(ref_path)
+        packed_path = f"{get_git_dir()}/packed-refs"
+        refname = os.path.normpath(ref)
+        if refname in _read_packed_refs():
+            with _lock(packed_path) as f:
+                refs = dict(_read_packed_refs())
+                refs.pop(refname, None)
+                _write_packed_refs(f, refs)
+            _commit_lock(packed_path)
+    os.remove(f"{ref_path}.lock")
 
 
 def _get_ref_internal(ref, deref):
-    ref_path = f"{GPGIT_DIR}/{ref}"
+    ref_path = f"{get_git_dir()}/{ref}"
     value = None
     if os.path.isfile(ref_path):
         with open(ref_path) as f:
             value = f.read().strip()
+    else:
+        value = _read_packed_refs().get(os.path.normpath(ref))
 
     symbolic = bool(value) and value.startswith("ref:")
     if symbolic:
@@ -66,16 +234,23 @@ def _get_ref_internal(ref, deref):
 
 
 def get_head():
-    if os.path.isfile(f"{GPGIT_DIR}/HEAD"):
-        with open(f"{GPGIT_DIR}/HEAD") as f:
+    if os.path.isfile(f"{get_git_dir()}/HEAD"):
+        with open(f"{get_git_dir()}/HEAD") as f:
             return f.read().strip()
 
 
+def _iter_loose_refs():
+    for root, _, filenames in os.walk(f"{get_git_dir()}/refs/"):
+        root = os.path.relpath(root, get_git_dir())
+        for name in filenames:
+            if not name.endswith(".lock"):
+                yield f"{root}/{name}"
+
+
 def iter_refs(prefix="", deref=True):
+    packed = _read_packed_refs()
     refs = ["HEAD", "COMBINE_HEAD"]
-    for root, _, filenames in os.walk(f"{GPGIT_DIR}/refs/"):
-        root = os.path.relpath(root, GPGIT_DIR)
-        refs.extend(f"{root}/{name}" for name in filenames)
+    refs.extend(sorted(set(_iter_loose_refs()).union(packed)))
 
     for refname in refs:
         if not refname.startswith(prefix):
@@ -85,49 +260,894 @@ def iter_refs(prefix="", deref=True):
             yield refname, ref
 
 
+def pack_refs():
+    # Fold every loose ref under refs/ into packed-refs. A loose ref is only
+    # removed if it still holds the value that was packed
+    packed_path = f"{get_git_dir()}/packed-refs"
+    with _lock(packed_path) as f:
+        refs = dict(_read_packed_refs())
+        loose = {}
+        for refname in _iter_loose_refs():
+            ref = _get_ref_internal(refname, deref=False)[1]
+            if ref.value and not ref.symbolic:
+                loose[refname] = refs[refname] = ref.value
+        _write_packed_refs(f, refs)
+    _commit_lock(packed_path)
+
+    for refname, value in loose.items():
+        ref_path = f"{get_git_dir()}/{refname}"
+        with _lock(ref_path):
+            if _get_ref_internal(refname, deref=False)[1].value == value:
+                os.remove(ref_path)
+        os.remove(f"{ref_path}.lock")
+    return len(loose)
+
+
+IndexStat = namedtuple("IndexStat", ["size", "mtime_ns", "ctime_ns", "inode", "mode"])
+
+
+def stat_path(path):
+    st = os.stat(path)
+    return IndexStat(st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, st.st_mode)
+
+
+# .gpgit/index: header, one fixed-size record per path sorted by path, the
+# paths themselves, then the cached directory trees
+#   record: path offset and length, obj_id, stat data (all zero if none)
+#   tree: obj_id, path length, path
+INDEX_SIGNATURE = b"GPIN"
+INDEX_VERSION = 3
+
+_INDEX_HEADER = struct.Struct(">4sIIII")
+_INDEX_ENTRY = struct.Struct(">II20sQqqQI")
+_INDEX_TREE = struct.Struct(">20sH")
+
+
+class _IndexStats:
+    def is_racy(self, stat):
+        # A file modified in the same clock tick as the index was written may
+        # still change without its stat data changing, so it can't be trusted
+        return stat.mtime_ns >= self.timestamp
+
+    def get_cached_obj_id(self, path, stat):
+        cached = self.get_stat(path)
+        if not cached or cached[1] != stat or self.is_racy(stat):
+            return None
+        return cached[0]
+
+
+class Index(_IndexStats, dict):
+    # Maps path -> obj_id. `stats` remembers, per path, the stat data of the
+    # working file the last time it was hashed and the obj_id it hashed to.
+    # `trees` maps directory -> tree id ("" for the root) for directories
+    # whose entries haven't changed since their tree was last written
+    def __init__(self, entries=(), stats=None, timestamp=0, trees=None):
+        super().__init__(entries)
+        self.stats = stats or {}
+        self.timestamp = timestamp
+        self.trees = trees or {}
+        self.changed = False
+
+    def __setitem__(self, path, obj_id):
+        if self.get(path) != obj_id:
+            self.invalidate(path)
+        super().__setitem__(path, obj_id)
+
+    def __delitem__(self, path):
+        super().__delitem__(path)
+        self.invalidate(path)
+
+    def pop(self, path, *default):
+        if path in self:
+            self.invalidate(path)
+        return super().pop(path, *default)
+
+    def update(self, entries=()):
+        for path, obj_id in dict(entries).items():
+            self[path] = obj_id
+
+    def clear(self):
+        super().clear()
+        self.trees.clear()
+        self.changed = True
+
+    def invalidate(self, path):
+        self.changed = True
+        self.trees.pop("", None)
+        while "/" in path:
+            path = path.rpartition("/")[0]
+            self.trees.pop(path, None)
+
+    def get_stat(self, path):
+        return self.stats.get(path)
+
+    def update_stat(self, path, obj_id, stat):
+        # Only stats matching the indexed obj_id are kept on disk
+        if obj_id == self.get(path) and self.stats.get(path) != (obj_id, stat):
+            self.changed = True
+        self.stats[path] = (obj_id, stat)
+
+
+class IndexView(_IndexStats, Mapping):
+    # Read-only index straight from the mapped file: lookups binary search the
+    # sorted records, nothing is parsed until it is asked for
+    def __init__(self, data, timestamp):
+        self.data = data
+        self.timestamp = timestamp
+        signature, version, self.count, self.tree_count, paths_size = (
+            _INDEX_HEADER.unpack_from(data)
+        )
+        assert signature == INDEX_SIGNATURE, "Not an index"
+        assert version == INDEX_VERSION, f"Unsupported index version {version}"
+        self.paths_start = _INDEX_HEADER.size + _INDEX_ENTRY.size * self.count
+        self.trees_start = self.paths_start + paths_size
+        self._trees = None
+
+    def _entry(self, i):
+        offset = _INDEX_HEADER.size + _INDEX_ENTRY.size * i
+        return _INDEX_ENTRY.unpack_from(self.data, offset)
+
+    def _path(self, entry):
+        start = self.paths_start + entry[0]
+        return self.data[start : start + entry[1]]
+
+    def _find(self, path):
+        path = path.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if self._path(entry) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            entry = self._entry(lo)
+            if self._path(entry) == path:
+                return entry
+        return None
+
+    def _iter_entries(self):
+        for entry in _INDEX_ENTRY.iter_unpack(
+            self.data[_INDEX_HEADER.size : self.paths_start]
+        ):
+            yield self._path(entry).decode(), entry
+
+    def __getitem__(self, path):
+        entry = self._find(path)
+        if entry is None:
+            raise KeyError(path)
+        return entry[2].hex()
+
+    def __iter__(self):
+        for path, _ in self._iter_entries():
+            yield path
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        return [(path, entry[2].hex()) for path, entry in self._iter_entries()]
+
+    def get_stat(self, path):
+        entry = self._find(path)
+        if entry is None or not entry[7]:
+            return None
+        return entry[2].hex(), IndexStat(*entry[3:])
+
+    @property
+    def trees(self):
+        if self._trees is None:
+            self._trees = {}
+            pos = self.trees_start
+            for _ in range(self.tree_count):
+                obj_id, length = _INDEX_TREE.unpack_from(self.data, pos)
+                pos += _INDEX_TREE.size
+                self._trees[self.data[pos : pos + length].decode()] = obj_id.hex()
+                pos += length
+        return self._trees
+
+    def load(self):
+        entries = {}
+        stats = {}
+        for path, entry in self._iter_entries():
+            entries[path] = entry[2].hex()
+            if entry[7]:
+                stats[path] = (entries[path], IndexStat(*entry[3:]))
+        return Index(entries, stats, self.timestamp, dict(self.trees))
+
+
+def _read_json_index(index_path):
+    with open(index_path) as f:
+        data = json.load(f)
+    if not isinstance(data.get("entries"), dict):
+        # Oldest index, a plain path -> obj_id mapping without stat data
+        return Index(data)
+
+    stats = {
+        path: (obj_id, IndexStat(*stat))
+        for path, (obj_id, *stat) in data["stats"].items()
+    }
+    return Index(
+        data["entries"],
+        stats,
+        os.stat(index_path).st_mtime_ns,
+        data.get("trees"),
+    )
+
+
+@contextmanager
+def read_index():
+    # Yields a read-only index and never writes it back
+    index_path = f"{get_git_dir()}/index"
+    if not os.path.isfile(index_path) or not os.path.getsize(index_path):
+        yield Index()
+        return
+
+    with open(index_path, "rb") as f:
+        if f.read(len(INDEX_SIGNATURE)) != INDEX_SIGNATURE:
+            # JSON index from an older gp-git, rewritten on the next change
+            yield _read_json_index(index_path)
+            return
+        timestamp = os.fstat(f.fileno()).st_mtime_ns
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        yield IndexView(data, timestamp)
+    finally:
+        data.close()
+
+
+def _write_index(index):
+    # Files changed in the clock tick the index is written in could change
+    # again unseen, so their stats are smudged and they are hashed again next
+    # time. The temp file's mtime is a lower bound for the index's own
+    fd, tmp_path = make_temp_file(get_git_dir(), "tmp-index-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            timestamp = os.fstat(out.fileno()).st_mtime_ns
+            paths = sorted(index)
+            records = []
+            path_data = []
+            offset = 0
+            for path in paths:
+                encoded = path.encode()
+                obj_id = index[path]
+                cached = index.stats.get(path)
+                if cached and cached[0] == obj_id and cached[1].mtime_ns < timestamp:
+                    stat = cached[1]
+                else:
+                    stat = IndexStat(0, 0, 0, 0, 0)
+                records.append(
+                    _INDEX_ENTRY.pack(offset, len(encoded), bytes.fromhex(obj_id), *stat)
+                )
+                path_data.append(encoded)
+                offset += len(encoded)
+
+            trees = []
+            for path, obj_id in sorted(index.trees.items()):
+                encoded = path.encode()
+                trees.append(
+                    _INDEX_TREE.pack(bytes.fromhex(obj_id), len(encoded)) + encoded
+                )
+
+            out.write(
+                _INDEX_HEADER.pack(
+                    INDEX_SIGNATURE, INDEX_VERSION, len(paths), len(trees), offset
+                )
+            )
+            out.write(b"".join(records))
+            out.write(b"".join(path_data))
+            out.write(b"".join(trees))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, f"{get_git_dir()}/index")
+
+
 @contextmanager
 def get_index():
-    index = {}
-    if os.path.isfile(f"{GPGIT_DIR}/index"):
-        with open(f"{GPGIT_DIR}/index") as f:
-            index = json.load(f)
+    # Yields an index to change, written back only if it was changed
+    with read_index() as index:
+        if not isinstance(index, Index):
+            index = index.load()
+    trees = dict(index.trees)
     yield index
 
-    with open(f"{GPGIT_DIR}/index", "w") as f:
-        json.dump(index, f)
+    if index.changed or index.trees != trees:
+        _write_index(index)
+
+
+def _object_path(obj_id):
+    return f"{get_git_dir()}/objects/{obj_id[:2]}/{obj_id[2:]}"
+
+
+def _new_object_path(obj_id):
+    assert get_git_dir(), "Not in a gp-git repository"
+    obj_path = _object_path(obj_id)
+    os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+    return obj_path
+
+
+def _find_loose_object(obj_id, objects_dir=None):
+    objects_dir = objects_dir or f"{get_git_dir()}/objects"
+    # Repos from before the fan-out layout keep objects directly in objects/
+    for obj_path in (
+        f"{objects_dir}/{obj_id[:2]}/{obj_id[2:]}",
+        f"{objects_dir}/{obj_id}",
+    ):
+        if os.path.isfile(obj_path):
+            return obj_path
+    return None
+
+
+_alternates = {}
+
+
+def _get_alternates():
+    # Object directories of other repositories whose objects this one uses
+    # as its own, see download --shared
+    alternates_path = f"{get_git_dir()}/objects/info/alternates"
+    try:
+        mtime = os.stat(alternates_path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    key = os.path.abspath(alternates_path)
+    cached = _alternates.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(alternates_path) as f:
+        dirs = [line.strip() for line in f if line.strip()]
+    _alternates[key] = (mtime, dirs)
+    return dirs
 
 
-def fingerprint(data, type_="blob"):
+def add_alternate(objects_dir):
+    objects_dir = os.path.abspath(objects_dir)
+    if objects_dir in _get_alternates():
+        return
+    os.makedirs(f"{get_git_dir()}/objects/info", exist_ok=True)
+    with open(f"{get_git_dir()}/objects/info/alternates", "a") as f:
+        f.write(f"{objects_dir}\n")
+
+
+def _find_object(obj_id):
+    # Returns the path of the loose object or None, and (pack, offset) or
+    # None, looking in this repository first and then in its alternates
+    for objects_dir in (f"{get_git_dir()}/objects", *_get_alternates()):
+        obj_path = _find_loose_object(obj_id, objects_dir)
+        if obj_path:
+            return obj_path, None
+        packed = pack.find_object(f"{objects_dir}/pack", obj_id)
+        if packed:
+            return None, packed
+    return None, None
+
+
+_OBJECT_ID = re.compile("[0-9a-f]{40}")
+
+
+def _iter_loose_objects():
+    objects_dir = f"{get_git_dir()}/objects"
+    for name in os.listdir(objects_dir):
+        path = f"{objects_dir}/{name}"
+        if _OBJECT_ID.fullmatch(name):
+            yield name, path
+        elif len(name) == 2 and os.path.isdir(path):
+            for rest in os.listdir(path):
+                if _OBJECT_ID.fullmatch(name + rest):
+                    yield name + rest, f"{path}/{rest}"
+
+
+def _pack_dir():
+    return f"{get_git_dir()}/objects/pack"
+
+
+def _compression_level():
+    return int(get_config("compression", zlib.Z_DEFAULT_COMPRESSION))
+
+
+def fingerprint(data, type_="blob", write=True):
     obj = type_.encode() + b"\x00" + data
     obj_id = hashlib.sha1(obj).hexdigest()
-    with open(f"{GPGIT_DIR}/objects/{obj_id}", "wb") as out:
-        out.write(obj)
+    # Outside a repository there is nowhere to store it, only hash it
+    if write and get_git_dir() and not object_exists(obj_id):
+        # Renamed into place whole, so a crash or another writer never
+        # leaves a cut-short object behind for object_exists to trust
+        obj_path = _new_object_path(obj_id)
+        fd, tmp_path = make_temp_file(os.path.dirname(obj_path))
+        try:
+            with os.fdopen(fd, "wb") as out:
+                out.write(zlib.compress(obj, _compression_level()))
+            os.replace(tmp_path, obj_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
     return obj_id
 
 
-def get_object(obj_id, expected="blob"):
-    with open(f"{GPGIT_DIR}/objects/{obj_id}", "rb") as f:
-        obj = f.read()
+def fingerprint_file(path, type_="blob", write=True):
+    with open(path, "rb") as f:
+        # Most files are far smaller than a chunk, so size the buffer to fit
+        size = os.fstat(f.fileno()).st_size
+        return fingerprint_stream(f, type_, write, max(size, 1))
+
+
+def fingerprint_stream(stream, type_="blob", write=True, size_hint=None):
+    header = type_.encode() + b"\x00"
+    sha = hashlib.sha1(header)
+    buf = memoryview(bytearray(min(size_hint or CHUNK_SIZE, CHUNK_SIZE)))
+
+    def iter_chunks():
+        while True:
+            size = stream.readinto(buf)
+            if not size:
+                return
+            sha.update(buf[:size])
+            yield buf[:size]
+
+    if not write or not get_git_dir():
+        for _ in iter_chunks():
+            pass
+        return sha.hexdigest()
+
+    # The id is only known once everything is read, so stream into a temp
+    # file next to the objects and rename it into place
+    fd, tmp_path = make_temp_file(f"{get_git_dir()}/objects")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            compressor = zlib.compressobj(_compression_level())
+            out.write(compressor.compress(header))
+            for chunk in iter_chunks():
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+        obj_id = sha.hexdigest()
+        if object_exists(obj_id):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, _new_object_path(obj_id))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return obj_id
+
+
+def _decode_object(data):
+    if data.startswith(ZLIB_MAGIC):
+        return zlib.decompress(data)
+    return data
+
+
+def _read_object(obj_id):
+    obj_path, packed = _find_object(obj_id)
+    if (obj_path, packed) == (None, None) and fetch_objects([obj_id]):
+        obj_path, packed = _find_object(obj_id)
+    if packed:
+        found_pack, offset = packed
+        return found_pack.read(offset)
+    if obj_path is None:
+        raise FileNotFoundError(f"No such object {obj_id}")
+
+    with open(obj_path, "rb") as f:
+        obj = _decode_object(f.read())
 
     type_, _, content = obj.partition(b"\x00")
-    type_ = type_.decode()
+    return type_.decode(), content
+
+
+class ObjectCache:
+    # Least recently used objects are dropped once the cached content goes over
+    # max_size. Entries are keyed by repository too, since a lookup in one
+    # repository must not find an object that only another one has
+    def __init__(self, name, max_size=CACHE_SIZE):
+        self.name = name
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def get(self, obj_id):
+        key = (os.getcwd(), get_git_dir(), obj_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, obj_id, value, size):
+        if size > self.max_size:
+            return
+        key = (os.getcwd(), get_git_dir(), obj_id)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            self._trim()
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            self._trim()
+
+    def clear(self, repository=None):
+        # Everything, or only the entries of one repository, given by the
+        # absolute path of its .gpgit
+        with self._lock:
+            if repository is None:
+                self._entries.clear()
+                self.size = 0
+                return
+            for key in [
+                key
+                for key in self._entries
+                if os.path.normpath(os.path.join(key[0], key[1])) == repository
+            ]:
+                self.size -= self._entries.pop(key)[1]
+
+    def _trim(self):
+        while self.size > self.max_size:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
+
+
+_caches = {}
+_object_cache = ObjectCache("objects")
+
+
+def clear_caches():
+    # Drops what the caches of the whole process hold for the current
+    # repository, e.g. once it is no longer used
+    repository = os.path.abspath(get_git_dir())
+    for cache in _caches.values():
+        cache.clear(repository)
+    _packed_refs.pop(f"{repository}/packed-refs", None)
+    _alternates.pop(f"{repository}/objects/info/alternates", None)
+    _configs.pop(f"{repository}/config", None)
 
+
+def set_cache_size(max_size):
+    for cache in _caches.values():
+        cache.resize(max_size)
+
+
+def get_cache_stats():
+    return {
+        name: (cache.hits, cache.misses, len(cache._entries), cache.size)
+        for name, cache in _caches.items()
+    }
+
+
+def get_object(obj_id, expected="blob"):
+    cached = _object_cache.get(obj_id)
+    if cached is None:
+        cached = _read_object(obj_id)
+        _object_cache.put(obj_id, cached, len(cached[1]))
+    type_, content = cached
     if expected is not None:
         assert type_ == expected, f"Expected {expected}, got {type_}"
     return content
 
 
+def _iter_decoded_chunks(f):
+    chunk = f.read(CHUNK_SIZE)
+    if not chunk.startswith(ZLIB_MAGIC):
+        while chunk:
+            yield chunk
+            chunk = f.read(CHUNK_SIZE)
+        return
+
+    # Cap each output chunk, highly compressible blobs would otherwise
+    # inflate a single read to many times CHUNK_SIZE
+    decompressor = zlib.decompressobj()
+    while chunk:
+        data = decompressor.decompress(chunk, CHUNK_SIZE)
+        if data:
+            yield data
+        chunk = decompressor.unconsumed_tail or f.read(CHUNK_SIZE)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def iter_object(obj_id, expected="blob"):
+    obj_path, packed = _find_object(obj_id)
+    if packed:
+        found_pack, offset = packed
+        type_, chunks = found_pack.iter_read(offset)
+        if expected is not None:
+            assert type_ == expected, f"Expected {expected}, got {type_}"
+        yield from chunks
+        return
+    if obj_path is None:
+        # Left out by a partial download, see fetch_objects
+        yield get_object(obj_id, expected)
+        return
+
+    with open(obj_path, "rb") as f:
+        chunks = _iter_decoded_chunks(f)
+        header = b""
+        while b"\x00" not in header:
+            chunk = next(chunks, b"")
+            assert chunk, f"Corrupt object {obj_id}"
+            header += chunk
+
+        type_, _, content = header.partition(b"\x00")
+        type_ = type_.decode()
+        if expected is not None:
+            assert type_ == expected, f"Expected {expected}, got {type_}"
+
+        if content:
+            yield content
+        yield from chunks
+
+
+def copy_object(obj_id, out, expected="blob"):
+    for chunk in iter_object(obj_id, expected):
+        out.write(chunk)
+
+
+def fan_out_objects():
+    count = 0
+    for obj_id, obj_path in _iter_loose_objects():
+        if obj_path != _object_path(obj_id):
+            os.replace(obj_path, _new_object_path(obj_id))
+            count += 1
+    return count
+
+
+def compress_objects():
+    # Objects written before compression was introduced are stored raw;
+    # their ids are over the uncompressed bytes, so they only need recoding
+    count = 0
+    for _, obj_path in _iter_loose_objects():
+        with open(obj_path, "rb") as f:
+            data = f.read()
+        if data.startswith(ZLIB_MAGIC):
+            continue
+
+        fd, tmp_path = make_temp_file(f"{get_git_dir()}/objects")
+        with os.fdopen(fd, "wb") as out:
+            out.write(zlib.compress(data, _compression_level()))
+        os.replace(tmp_path, obj_path)
+        count += 1
+    return count
+
+
 def object_exists(obj_id):
-    return os.path.isfile(f"{GPGIT_DIR}/objects/{obj_id}")
+    return _find_object(obj_id) != (None, None)
+
+
+def transfer_objects(objects, from_git_dir, to_git_dir, deltas=True, share=None):
+    # Streams the objects from one repository into a single new pack in the
+    # other, instead of copying them file by file. On the same filesystem
+    # the files holding them are shared instead
+    objects = list(objects)
+    if not objects:
+        return None
+    if share is None:
+        share = same_filesystem(from_git_dir, to_git_dir)
+    if share:
+        _share_objects(objects, from_git_dir, to_git_dir)
+        return None
+
+    def read_object(obj_id):
+        with change_git_dir(from_git_dir):
+            return _read_object(obj_id)
+
+    def iter_blob(obj_id):
+        # Only the lookup needs from_git_dir, the chunks are read after it
+        with change_git_dir(from_git_dir):
+            chunks = iter_object(obj_id)
+            first = next(chunks, b"")
+        yield first
+        yield from chunks
+
+    with change_git_dir(to_git_dir):
+        return pack.write_pack(_pack_dir(), objects, read_object, deltas, iter_blob)
+
+
+def same_filesystem(from_git_dir, to_git_dir):
+    with change_git_dir(from_git_dir):
+        from_dev = os.stat(f"{get_git_dir()}/objects").st_dev
+    with change_git_dir(to_git_dir):
+        return os.stat(f"{get_git_dir()}/objects").st_dev == from_dev
+
+
+def _share_objects(objects, from_git_dir, to_git_dir):
+    # Run in the order iter_copy_jobs gives: packs, then saves
+    last = []
+    with change_git_dir(from_git_dir):
+        jobs = list(iter_copy_jobs(objects, to_git_dir, last))
+    for job in jobs + last:
+        job()
+
+
+def iter_copy_jobs(objects, to_git_dir, last):
+    # Jobs (see transfer.run) that share objects of this repository with
+    # another one on the same filesystem. They only use the paths they are
+    # given, so they can run on other threads while this repository stays
+    # the current one. A save must not show up before what it refers to,
+    # or a download cut short in between would leave one that looks
+    # complete. So objects must come in dependency order, and the jobs that
+    # bring saves go in `last`, to run one at a time once the others are
+    # done: shared packs first, oldest first, since a pack only refers to
+    # what was there before it, then loose saves in the order they came
+    with change_git_dir(to_git_dir):
+        objects_dir = f"{get_git_dir()}/objects"
+    saves = []
+    packs = {}
+
+    for type_, obj_id, _ in objects:
+        obj_path, packed = _find_object(obj_id)
+        assert obj_path or packed, f"No such object {obj_id}"
+        if packed:
+            # Shared whole, with objects that weren't asked for
+            packs[packed[0].path] = os.stat(f"{packed[0].path}.idx").st_mtime_ns
+            continue
+        job = functools.partial(_copy_loose_object, obj_path, objects_dir, obj_id)
+        if type_ == "save":
+            saves.append(job)
+        else:
+            yield job
+
+    for path in sorted(packs, key=packs.get):
+        last.append(functools.partial(_link_pack, path, f"{objects_dir}/pack"))
+    last.extend(saves)
+
+
+def _copy_loose_object(obj_path, objects_dir, obj_id):
+    dst = f"{objects_dir}/{obj_id[:2]}/{obj_id[2:]}"
+    if not os.path.isfile(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _link_file(obj_path, dst)
+
+
+def _link_pack(path, pack_dir):
+    # A pack is shared whole; the index goes last, since readers only look
+    # for packs that have one
+    name = os.path.basename(path)
+    if not os.path.isfile(f"{pack_dir}/{name}.idx"):
+        os.makedirs(pack_dir, exist_ok=True)
+        _link_file(f"{path}.pack", f"{pack_dir}/{name}.pack")
+        _link_file(f"{path}.idx", f"{pack_dir}/{name}.idx")
+        pack.forget_packs(pack_dir)
+
+
+def get_shallow():
+    # Saves whose parents were left out by download --depth
+    try:
+        with open(f"{get_git_dir()}/shallow") as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def set_shallow(obj_ids):
+    shallow_path = f"{get_git_dir()}/shallow"
+    if not obj_ids:
+        if os.path.exists(shallow_path):
+            os.remove(shallow_path)
+        return
+    with open(shallow_path, "w") as f:
+        f.write("".join(f"{obj_id}\n" for obj_id in sorted(obj_ids)))
 
 
-def download_object_if_missing(obj_id, remote_git_dir):
-    if object_exists(obj_id):
+_fetch_lock = threading.Lock()
+
+
+def fetch_objects(obj_ids):
+    # Copies objects that a partial download left out from the promisor
+    # remote recorded by it, in one batch. Ids the remote doesn't have
+    # either are left for the caller to report. Returns the number fetched
+    promisor = get_config("promisor")
+    if not promisor:
+        return 0
+    missing = sorted({obj_id for obj_id in obj_ids if not object_exists(obj_id)})
+    if not missing:
+        return 0
+
+    # Threads checking out at once would otherwise fetch the same blobs
+    with _fetch_lock:
+        if protocol.is_url(promisor):
+            protocol.fetch_objects(promisor, missing, _pack_dir())
+            return sum(object_exists(obj_id) for obj_id in missing)
+        local_path = os.path.dirname(get_git_dir())
+        with change_git_dir(promisor):
+            objects = [
+                ("blob", obj_id, "") for obj_id in missing if object_exists(obj_id)
+            ]
+        # As one new pack: a shared one would bring along the other blobs
+        transfer_objects(objects, promisor, local_path, share=False)
+    return len(objects)
+
+
+FICLONE = 0x40049409
+
+
+def _link_file(src, dst):
+    # Objects are never changed in place, so two repositories can share one
+    # file. Where hardlinks aren't allowed, try a copy-on-write clone, then
+    # a plain copy
+    try:
+        os.link(src, dst)
+        return
+    except FileExistsError:
         return
-    remote_git_dir += "/.gpgit"
-    shutil.copy(f"{remote_git_dir}/objects/{obj_id}", f"{GPGIT_DIR}/objects/{obj_id}")
+    except OSError:
+        pass
+
+    fd, tmp_path = make_temp_file(os.path.dirname(dst))
+    try:
+        with open(src, "rb") as f, os.fdopen(fd, "wb") as out:
+            if not _clone_file(f, out):
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, dst)
+
+
+def _clone_file(f, out):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(out.fileno(), FICLONE, f.fileno())
+        return True
+    except OSError:
+        return False
+
 
+def pack_objects(objects, gc=False):
+    # Packs what is loose, whose loose copies are deleted afterwards. With
+    # gc, everything in the old packs goes into the new one too, so they can
+    # be deleted as well
+    pack_dir = _pack_dir()
+    objects = list(objects)
+    if not gc:
+        objects = [entry for entry in objects if _find_loose_object(entry[1])]
+    elif get_config("promisor"):
+        # Blobs left on the promisor remote stay there
+        objects = [entry for entry in objects if object_exists(entry[1])]
+    old_packs = pack.get_packs(pack_dir) if gc else []
+    known = {obj_id for _, obj_id, _ in objects}
+    for old_pack in old_packs:
+        for obj_id in old_pack:
+            if obj_id not in known:
+                known.add(obj_id)
+                type_, _ = old_pack.read(old_pack.find(obj_id))
+                objects.append((type_, obj_id, ""))
+    if not objects:
+        return None, 0
 
-def throw_object(obj_id, remote_git_dir):
-    remote_git_dir += "/.gpgit"
-    shutil.copy(f"{GPGIT_DIR}/objects/{obj_id}", f"{remote_git_dir}/objects/{obj_id}")
+    name = pack.write_pack(pack_dir, objects, _read_object, iter_object=iter_object)
+    if gc:
+        old_paths = [old_pack.path for old_pack in old_packs]
+        pack.close_packs(pack_dir)
+        for path in old_paths:
+            if path != f"{pack_dir}/{name}":
+                os.remove(f"{path}.idx")
+                os.remove(f"{path}.pack")
+    for obj_id in known:
+        obj_path = _find_loose_object(obj_id)
+        if obj_path:
+            os.remove(obj_path)
+            try:
+                os.rmdir(os.path.dirname(obj_path))
+            except OSError:
+                pass
+    return name, len(known)
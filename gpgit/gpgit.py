@@ -1,12 +1,17 @@
 import argparse
 import sys
 import os
-import textwrap
+from contextlib import contextmanager
 from . import files
-from . import base
-from . import compare
-from . import remote
-import subprocess
+from .lazy import lazy_import
+
+# Loaded by the commands that use them, so the rest start faster
+base = lazy_import(f"{__package__}.base")
+compare = lazy_import(f"{__package__}.compare")
+remote = lazy_import(f"{__package__}.remote")
+server = lazy_import(f"{__package__}.server")
+subprocess = lazy_import("subprocess")
+textwrap = lazy_import("textwrap")
 
 
 def print_help():
@@ -25,21 +30,28 @@ def print_help():
 
     \033[1;33mAvailable commands:\033[0m
       \033[1;36mstart\033[0m         Initializes a new project in your current working directory [\033[1;31minit\033[0m]                   | Usage: \033[1;32mgp-git start\033[0m
-      \033[1;36mtrack\033[0m         Tracks files in your repository[\033[1;31madd\033[0m]                                                 | Usage: \033[1;32mgp-git track [file-name1] [file-name2]...\033[0m
+      \033[1;36mtrack\033[0m         Tracks files in your repository[\033[1;31madd\033[0m]                                                 | Usage: \033[1;32mgp-git track [-j jobs] [file-name1] [file-name2]...\033[0m
       \033[1;36msave\033[0m          Records changes to the repository with a message describing the changes [\033[1;31mcommit\033[0m]     | Usage: \033[1;32mgp-git save ["Your commit message"]\033[0m
       \033[1;36mthrow\033[0m         Sends your saved changes to the remote repository [\033[1;31mpush\033[0m]                             | Usage: \033[1;32mgp-git throw [remote] [branch-name]\033[0m
       \033[1;36mlabel\033[0m         Creates, lists, deletes or verifies a tag object signed with GPG [\033[1;31mtag\033[0m]               | Usage: \033[1;32mgp-git label [label-name] [obj-id]\033[0m
       \033[1;36mbranch\033[0m        Creates a new branch                                                                 | Usage: \033[1;32mgp-git branch [branch-name]\033[0m
-      \033[1;36mswitch\033[0m        Switches branches or restores working tree files [\033[1;31mcheckout\033[0m]                          | Usage: \033[1;32mgp-git switch [branch-name]\033[0m
+      \033[1;36mswitch\033[0m        Switches branches or restores working tree files [\033[1;31mcheckout\033[0m]                          | Usage: \033[1;32mgp-git switch [-j jobs] [branch-name]\033[0m
       \033[1;36mhistory\033[0m       Displays the save history of the repository [\033[1;31mlog\033[0m]                                    | Usage: \033[1;32mgp-git history\033[0m
       \033[1;36mcombine\033[0m       Combines changes from one branch into another [\033[1;31mmerge\033[0m]                                | Usage: \033[1;32mgp-git combine [branch-name]\033[0m
-      \033[1;36mfingerprint\033[0m   Computes the object ID (hash) of a file and optionally creates a blob from it [\033[1;31mhash\033[0m] | Usage: \033[1;32mgp-git fingerprint [file-name]\033[0m
+      \033[1;36mfingerprint\033[0m   Computes the object ID (hash) of a file and optionally creates a blob from it [\033[1;31mhash\033[0m] | Usage: \033[1;32mgp-git fingerprint [-w] [file-name]\033[0m
       \033[1;36mview\033[0m          Shows content or type and size information for repository objects [\033[1;31mcat-file\033[0m]         | Usage: \033[1;32mgp-git view [obj-id]\033[0m
       \033[1;36mvis\033[0m           Visualizes commit history using graph structures                                     | Usage: \033[1;32mgp-git vis\033[0m
       \033[1;36mshow\033[0m          Displays various types of objects (commits, trees, blobs, tags)                      | Usage: \033[1;32mgp-git show [obj-id]\033[0m
       \033[1;36mwrite-tree\033[0m    Creates a tree object from the current index                                         | Usage: \033[1;32mgp-git write-tree\033[0m
       \033[1;36mread-tree\033[0m     Reads tree information into the index                                                | Usage: \033[1;32mgp-git read-tree tree-id\033[0m
       \033[1;36mcompare\033[0m       Shows changes between commits, commit and working tree, etc [\033[1;31mdiff\033[0m]                   | Usage: \033[1;32mgp-git compare [--cached] [save]\033[0m
+      \033[1;36mpack\033[0m          Packs every reachable object into a single delta-compressed pack file [\033[1;31mrepack\033[0m]       | Usage: \033[1;32mgp-git pack\033[0m
+      \033[1;36mgc\033[0m            Repacks all objects into one pack and removes the loose copies [\033[1;31mgc\033[0m]                  | Usage: \033[1;32mgp-git gc\033[0m
+      \033[1;36mbundle\033[0m        Writes branches and their objects to one file, or reads them back [\033[1;31mbundle\033[0m]           | Usage: \033[1;32mgp-git bundle create|unbundle file [refs]...\033[0m
+      \033[1;36mserve\033[0m         Serves this repository to other clones over a socket, at gpgit:// URLs [\033[1;31mdaemon\033[0m]      | Usage: \033[1;32mgp-git serve [--socket path | --port port]\033[0m
+      \033[1;36mpack-refs\033[0m     Moves all branches and labels into a single packed-refs file [\033[1;31mpack-refs\033[0m]             | Usage: \033[1;32mgp-git pack-refs\033[0m
+      \033[1;36mconfig\033[0m        Reads or sets a repository option, e.g. compression or cache_size (0 = off) [\033[1;31mconfig\033[0m] | Usage: \033[1;32mgp-git config key [value]\033[0m
+      \033[1;36mmigrate\033[0m       Upgrades the object store of a repository made by an older gp-git                    | Usage: \033[1;32mgp-git migrate\033[0m
     """
     print(logo)
     print(help_text)
@@ -47,17 +59,16 @@ def print_help():
 
 def start(args):
     base.start()
-    print(f"Created a new gpgit repository in {os.getcwd()}/{files.GPGIT_DIR}")
+    print(f"Created a new gpgit repository in {os.getcwd()}/{files.get_git_dir()}")
 
 
 def fingerprint(args):
-    with open(args.file, "rb") as f:
-        print(files.fingerprint(f.read()))
+    print(files.fingerprint_file(args.file, write=args.write))
 
 
 def view(args):
     sys.stdout.flush()
-    sys.stdout.buffer.write(files.get_object(args.object, expected=None))
+    files.copy_object(args.object, sys.stdout.buffer, expected=None)
 
 
 def read_tree(args):
@@ -94,36 +105,62 @@ def show(args):
         return
     save = base.get_save(args.obj_id)
     parent_tree = None
-    if save.parents:
-        parent_tree = base.get_save(save.parents[0]).tree
+    # The graph knows which parents a shallow download left out
+    parents = base.get_graph_entry(args.obj_id).parents
+    if parents:
+        parent_tree = base.get_graph_entry(parents[0]).tree
     _print_save(args.obj_id, save)
-    result = compare.comp_trees(base.get_tree(parent_tree), base.get_tree(save.tree))
+    result = compare.comp_trees(
+        base.iter_tree_changes(parent_tree, save.tree), workers=base.get_workers()
+    )
+    _write_output(result)
+
+
+def _write_output(chunks):
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
 
 
 def _compare(args):
     obj_id = args.save and base.get_obj_id(args.save)
     if args.save:
-        tree_from = base.get_tree(obj_id and base.get_save(obj_id).tree)
+        tree_from = obj_id and base.get_save(obj_id).tree
 
     if args.cached:
         tree_to = base.get_index_tree()
         if not args.save:
             obj_id = base.get_obj_id("@")
-            tree_from = base.get_tree(obj_id and base.get_save(obj_id).tree)
-        else:
-            tree_to = base.get_working_tree()
-            if not args.save:
-                tree_from = base.get_index_tree()
+            tree_from = obj_id and base.get_save(obj_id).tree
+    else:
+        tree_to = base.get_working_tree()
+        if not args.save:
+            tree_from = base.get_index_tree()
 
-        result = compare.comp_trees(tree_from, tree_to)
-        sys.stdout.flush()
-        sys.stdout.buffer.write(result)
+    result = compare.comp_trees(
+        base.iter_tree_changes(tree_from, tree_to),
+        working=not args.cached,
+        workers=base.get_workers(),
+    )
+    _write_output(result)
 
 
 def switch(args):
-    base.switch(args.save)
+    with _progress("Updating files") as progress:
+        base.switch(args.save, args.jobs, progress)
+
+
+@contextmanager
+def _progress(label):
+    if not sys.stderr.isatty():
+        yield None
+        return
+
+    def print_progress(done, total):
+        print(f"\r{label}: {done}/{total}", end="", file=sys.stderr, flush=True)
+
+    yield print_progress
+    print(file=sys.stderr)
 
 
 def label(args):
@@ -152,9 +189,8 @@ def vis(args):
             obj_ids.add(ref.value)
 
     for obj_id in base.iter_saves_and_parents(obj_ids):
-        save = base.get_save(obj_id)
         dot += f'"{obj_id}" [shape=box style=filled label="{obj_id[:10]}"]\n'
-        for parent in save.parents:
+        for parent in base.get_graph_entry(obj_id).parents:
             dot += f'"{obj_id}" -> "{parent}"\n'
 
     dot += "}"
@@ -180,13 +216,14 @@ def status(args):
 
     print("\nChanges to be saved:\n")
     HEAD_tree = HEAD and base.get_save(HEAD).tree
+    index_tree = base.get_index_tree()
     for path, action in compare.iter_changed_files(
-        base.get_tree(HEAD_tree), base.get_index_tree()
+        base.iter_tree_changes(HEAD_tree, index_tree)
     ):
         print(f"{action:>12}: {path}")
     print("\nChanges not staged for save:\n")
     for path, action in compare.iter_changed_files(
-        base.get_index_tree(), base.get_working_tree()
+        base.iter_tree_changes(index_tree, base.get_working_tree())
     ):
         print(f"{action:>12}: {path}")
 
@@ -204,29 +241,93 @@ def combine_base(args):
 
 
 def download(args):
-    remote.download(args.remote)
+    with _progress("Copying objects") as progress:
+        remote.download(
+            args.remote, args.shared, args.jobs, progress, args.depth, args.filter
+        )
 
 
 def throw(args):
     remote.throw(args.remote, f"refs/heads/{args.branch}")
 
 
+def serve(args):
+    if args.port is not None:
+        address = ("127.0.0.1", args.port)
+    else:
+        address = args.socket or f"{files.get_git_dir()}/serve.sock"
+    daemon = server.make_server(address)
+    print(f"Serving {server.get_url(daemon)}", flush=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        if isinstance(address, str):
+            os.remove(address)
+
+
+def bundle(args):
+    if args.action == "create":
+        refnames = args.refs or [name for name, _ in files.iter_refs("refs/heads/")]
+        refs, count = remote.create_bundle(args.file, refnames, not args.no_deltas)
+        print(f"Bundled {count} objects for {len(refs)} refs into {args.file}")
+    else:
+        for refname, value in sorted(remote.unbundle(args.file).items()):
+            print(f"{value} {refname}")
+
+
 def track(args):
-    base.track(args.files)
+    base.track(args.files, args.jobs)
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    commands = parser.add_subparsers(dest="command")
-    commands.required = True
+def pack(args):
+    name, count = base.pack_objects(gc=args.gc)
+    if name:
+        print(f"Packed {count} objects into {name}")
+    else:
+        print("Nothing to pack")
 
-    obj_id = base.get_obj_id
 
-    start_parser = commands.add_parser("start", help="Creates a new repository")
-    start_parser.set_defaults(func=start)
+def pack_refs(args):
+    print(f"Packed {files.pack_refs()} refs")
+
+
+def config(args):
+    if args.value is None:
+        print(files.get_config(args.key))
+    else:
+        files.set_config(args.key, args.value)
+
+
+def migrate(args):
+    print(f"Moved {files.fan_out_objects()} objects to the fan-out layout")
+    print(f"Compressed {files.compress_objects()} objects")
+
+
+def _print_cache_stats():
+    for name, (hits, misses, count, size) in files.get_cache_stats().items():
+        print(
+            f"{name} cache: {hits} hits, {misses} misses, "
+            f"{count} entries ({size} bytes)",
+            file=sys.stderr,
+        )
 
+
+def obj_id(name):
+    return base.get_obj_id(name)
+
+
+# Plumbing run over and over from hooks and scripts; only these commands'
+# parsers are built when one of them is run
+PLUMBING_COMMANDS = {"fingerprint", "view", "write-tree", "read-tree", "status"}
+
+
+def _add_plumbing_commands(commands):
     fingerprint_obj_parser = commands.add_parser("fingerprint")
     fingerprint_obj_parser.set_defaults(func=fingerprint)
+    fingerprint_obj_parser.add_argument("-w", "--write", action="store_true")
     fingerprint_obj_parser.add_argument("file")
 
     view_parser = commands.add_parser("view")
@@ -240,6 +341,14 @@ def main():
     read_tree_parser.set_defaults(func=read_tree)
     read_tree_parser.add_argument("tree", type=obj_id)
 
+    status_parser = commands.add_parser("status")
+    status_parser.set_defaults(func=status)
+
+
+def _add_commands(commands):
+    start_parser = commands.add_parser("start", help="Creates a new repository")
+    start_parser.set_defaults(func=start)
+
     save_parser = commands.add_parser("save")
     save_parser.set_defaults(func=save)
     save_parser.add_argument("-m", "--message", required=True)
@@ -259,7 +368,8 @@ def main():
 
     switch_parser = commands.add_parser("switch")
     switch_parser.set_defaults(func=switch)
-    switch_parser.add_argument("obj_id", type=obj_id)
+    switch_parser.add_argument("-j", "--jobs", type=int)
+    switch_parser.add_argument("save")
 
     label_parser = commands.add_parser("label")
     label_parser.set_defaults(func=label)
@@ -274,9 +384,6 @@ def main():
     vis_parser = commands.add_parser("vis")
     vis_parser.set_defaults(func=vis)
 
-    status_parser = commands.add_parser("status")
-    status_parser.set_defaults(func=status)
-
     reset_parser = commands.add_parser("reset")
     reset_parser.set_defaults(func=reset)
     reset_parser.add_argument("save", type=obj_id)
@@ -292,6 +399,10 @@ def main():
 
     download_parser = commands.add_parser("download")
     download_parser.set_defaults(func=download)
+    download_parser.add_argument("--shared", action="store_true")
+    download_parser.add_argument("-j", "--jobs", type=int)
+    download_parser.add_argument("--depth", type=int)
+    download_parser.add_argument("--filter", choices=["blob:none"])
     download_parser.add_argument("remote")
 
     throw_parser = commands.add_parser("throw")
@@ -299,14 +410,59 @@ def main():
     throw_parser.add_argument("remote")
     throw_parser.add_argument("branch")
 
+    serve_parser = commands.add_parser("serve")
+    serve_parser.set_defaults(func=serve)
+    serve_address = serve_parser.add_mutually_exclusive_group()
+    serve_address.add_argument("--socket")
+    serve_address.add_argument("--port", type=int)
+
+    bundle_parser = commands.add_parser("bundle")
+    bundle_parser.set_defaults(func=bundle)
+    bundle_parser.add_argument("action", choices=["create", "unbundle"])
+    bundle_parser.add_argument("--no-deltas", action="store_true")
+    bundle_parser.add_argument("file")
+    bundle_parser.add_argument("refs", nargs="*")
+
     track_parser = commands.add_parser("track")
     track_parser.set_defaults(func=track)
+    track_parser.add_argument("-j", "--jobs", type=int)
     track_parser.add_argument("files", nargs="+")
 
+    pack_parser = commands.add_parser("pack")
+    pack_parser.set_defaults(func=pack, gc=False)
+
+    gc_parser = commands.add_parser("gc")
+    gc_parser.set_defaults(func=pack, gc=True)
+
+    pack_refs_parser = commands.add_parser("pack-refs")
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    config_parser = commands.add_parser("config")
+    config_parser.set_defaults(func=config)
+    config_parser.add_argument("key")
+    config_parser.add_argument("value", nargs="?")
+
+    migrate_parser = commands.add_parser("migrate")
+    migrate_parser.set_defaults(func=migrate)
+
     help_parser = commands.add_parser("help", help="Show help information")
     help_parser.set_defaults(func=lambda args: print_help())
 
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-stats", action="store_true")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    _add_plumbing_commands(commands)
+    command = next((arg for arg in sys.argv[1:] if not arg.startswith("-")), None)
+    if command not in PLUMBING_COMMANDS:
+        _add_commands(commands)
+
     with files.change_git_dir('.'):
         args = parser.parse_args()
+        files.set_cache_size(int(files.get_config("cache_size", files.CACHE_SIZE)))
         args.func(args)
+        if args.cache_stats:
+            _print_cache_stats()
 
@@ -0,0 +1,152 @@
+import os
+import struct
+from collections import namedtuple
+from . import files
+
+# .gpgit/commit-graph: a header followed by one record per save, appended as
+# saves are made or first looked up
+#   record: save id, tree id, generation, parent count, parent ids
+SIGNATURE = b"GPCG"
+VERSION = 1
+
+_HEADER = struct.Struct(">4sI")
+_RECORD = struct.Struct(">20s20sIB")
+
+GraphEntry = namedtuple("GraphEntry", ["tree", "parents", "generation"])
+
+_graphs = {}
+
+
+def _graph_path():
+    return f"{files.get_git_dir()}/commit-graph"
+
+
+def _load():
+    # Only the records appended since the last call are parsed
+    graph_path = _graph_path()
+    key = os.path.abspath(graph_path)
+    try:
+        stat = os.stat(graph_path)
+    except FileNotFoundError:
+        _graphs.pop(key, None)
+        return {}
+
+    size = stat.st_size
+    # A graph that was rewritten, see remove_entries, is read from the start
+    ino, loaded, entries = _graphs.get(key, (stat.st_ino, 0, {}))
+    if ino != stat.st_ino or size < loaded:
+        loaded, entries = 0, {}
+    if size == loaded:
+        return entries
+
+    with open(graph_path, "rb") as f:
+        f.seek(loaded)
+        data = f.read(size - loaded)
+
+    pos = 0
+    if not loaded:
+        signature, version = _HEADER.unpack_from(data)
+        assert signature == SIGNATURE, "Not a commit graph"
+        assert version == VERSION, f"Unsupported commit graph version {version}"
+        pos = _HEADER.size
+    # A record being appended by another process may be cut short, leave it
+    # for the next load
+    while pos + _RECORD.size <= len(data):
+        obj_id, tree, generation, parent_count = _RECORD.unpack_from(data, pos)
+        end = pos + _RECORD.size + 20 * parent_count
+        if end > len(data):
+            break
+        parents = data[pos + _RECORD.size : end]
+        entries[obj_id.hex()] = GraphEntry(
+            tree.hex(),
+            tuple(parents[i : i + 20].hex() for i in range(0, len(parents), 20)),
+            generation,
+        )
+        pos = end
+
+    _graphs[key] = (stat.st_ino, loaded + pos, entries)
+    return entries
+
+
+def close():
+    # Drops the current repository's graph from memory
+    _graphs.pop(os.path.abspath(_graph_path()), None)
+
+
+def get_entry(obj_id):
+    return _load().get(obj_id)
+
+
+def _pack_records(entries):
+    records = []
+    for obj_id, entry in entries.items():
+        records.append(
+            _RECORD.pack(
+                bytes.fromhex(obj_id),
+                bytes.fromhex(entry.tree),
+                entry.generation,
+                len(entry.parents),
+            )
+        )
+        records.extend(bytes.fromhex(parent) for parent in entry.parents)
+    return b"".join(records)
+
+
+def add_entries(new_entries):
+    if not new_entries:
+        return
+    records = _pack_records(new_entries)
+
+    # One append per batch, so readers never see half a batch from us. The
+    # file is never opened to create it, see _create
+    while True:
+        try:
+            fd = os.open(_graph_path(), os.O_WRONLY | os.O_APPEND)
+            break
+        except FileNotFoundError:
+            _create()
+    with os.fdopen(fd, "ab") as f:
+        f.write(records)
+
+
+def remove_entries(obj_ids):
+    # Drops the entries of obj_ids and of every save after them, e.g. once
+    # a save at the edge of a shallow download gets its parents. They are
+    # added again, right this time, the next time they are looked up.
+    # Appends made meanwhile by other processes may be lost with them
+    removed = set(obj_ids)
+    entries = _load()
+    kept = {}
+    # Parents have lower generations, so they are decided first
+    for obj_id, entry in sorted(entries.items(), key=lambda item: item[1].generation):
+        if obj_id in removed or removed.intersection(entry.parents):
+            removed.add(obj_id)
+        else:
+            kept[obj_id] = entry
+    if len(kept) == len(entries):
+        return
+
+    graph_path = _graph_path()
+    fd, tmp_path = files.make_temp_file(os.path.dirname(graph_path))
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(_HEADER.pack(SIGNATURE, VERSION) + _pack_records(kept))
+        os.replace(tmp_path, graph_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _create():
+    # The file comes into place with its header already written, so two
+    # processes adding the first saves can't both write one
+    graph_path = _graph_path()
+    fd, tmp_path = files.make_temp_file(os.path.dirname(graph_path))
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(_HEADER.pack(SIGNATURE, VERSION))
+        os.link(tmp_path, graph_path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
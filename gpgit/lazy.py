@@ -0,0 +1,22 @@
+import importlib
+
+
+class LazyModule:
+    # Stands in for a module that is only imported once one of its
+    # attributes is first used, for imports most commands never need. The
+    # import system's own locks make that first use safe from any thread
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,420 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import zlib
+from collections import namedtuple
+from .lazy import lazy_import
+
+# For temp files; files imports this module first
+files = lazy_import(f"{__package__}.files")
+tempfile = lazy_import("tempfile")
+
+# pack-<sha>.pack: header, then one entry per object, then a SHA-1 trailer
+#   entry: type, compressed size, [base offset for deltas], zlib data
+# pack-<sha>.idx: header, fan-out table, sorted ids, pack offsets, pack SHA-1
+PACK_SIGNATURE = b"GPPK"
+INDEX_SIGNATURE = b"GPIX"
+VERSION = 1
+
+TYPES = {"blob": 1, "tree": 2, "save": 3}
+TYPE_NAMES = {value: name for name, value in TYPES.items()}
+DELTA = 4
+
+DELTA_WINDOW = 10
+DELTA_DEPTH = 10
+DELTA_MAX_SIZE = 4 << 20
+# Shorter matches cost more as a copy op than as literal bytes
+DELTA_MIN_COPY = 16
+# Larger entries are compressed and inflated a piece at a time
+CHUNK_SIZE = 1 << 20
+
+_HEADER = struct.Struct(">4sII")
+_ENTRY = struct.Struct(">BQ")
+_OFFSET = struct.Struct(">Q")
+_FANOUT = struct.Struct(">256I")
+_DELTA_HEADER = struct.Struct(">QQ")
+_COPY = struct.Struct(">BII")
+
+_IDS_START = _HEADER.size + _FANOUT.size
+
+
+def _index_lines(data):
+    lines = data.splitlines(keepends=True)
+    first = {}
+    offsets = [0]
+    for i, line in enumerate(lines):
+        first.setdefault(line, i)
+        offsets.append(offsets[-1] + len(line))
+    return lines, first, offsets
+
+
+_DeltaBase = namedtuple("_DeltaBase", ["offset", "data", "depth", "lines"])
+
+
+def create_delta(base, target, base_lines=None):
+    # Line-based copy/insert delta: runs of lines found in the base become
+    # copy ops, everything else is inserted literally
+    lines, first, offsets = base_lines or _index_lines(base)
+    delta = [_DELTA_HEADER.pack(len(base), len(target))]
+    literal = []
+
+    def flush_literal():
+        data = b"".join(literal)
+        for i in range(0, len(data), 127):
+            chunk = data[i : i + 127]
+            delta.append(bytes([len(chunk)]) + chunk)
+        literal.clear()
+
+    target_lines = target.splitlines(keepends=True)
+    i = 0
+    while i < len(target_lines):
+        j = first.get(target_lines[i])
+        if j is None:
+            literal.append(target_lines[i])
+            i += 1
+            continue
+
+        length = 1
+        while (
+            i + length < len(target_lines)
+            and j + length < len(lines)
+            and target_lines[i + length] == lines[j + length]
+        ):
+            length += 1
+        size = offsets[j + length] - offsets[j]
+        if size < DELTA_MIN_COPY:
+            literal.extend(target_lines[i : i + length])
+        else:
+            flush_literal()
+            delta.append(_COPY.pack(0x80, offsets[j], size))
+        i += length
+
+    flush_literal()
+    return b"".join(delta)
+
+
+def apply_delta(base, delta):
+    base_size, target_size = _DELTA_HEADER.unpack_from(delta)
+    assert len(base) == base_size, "Delta applied to the wrong base"
+
+    result = []
+    pos = _DELTA_HEADER.size
+    while pos < len(delta):
+        op = delta[pos]
+        if op & 0x80:
+            _, offset, size = _COPY.unpack_from(delta, pos)
+            result.append(base[offset : offset + size])
+            pos += _COPY.size
+        else:
+            result.append(delta[pos + 1 : pos + 1 + op])
+            pos += 1 + op
+
+    result = b"".join(result)
+    assert len(result) == target_size, "Corrupt delta"
+    return result
+
+
+def write_pack_stream(out, objects, read_object, deltas=True, iter_object=None):
+    # objects: (type_, obj_id, name) tuples. Blobs are sorted by name so
+    # versions of the same file land in each other's delta window. With
+    # iter_object to read blobs in chunks, those too large to delta are
+    # streamed rather than read whole. Returns the pack offset of each
+    # object and the pack checksum
+    objects = {obj_id: (type_, obj_id, name) for type_, obj_id, name in objects}
+    objects = sorted(
+        objects.values(),
+        key=lambda entry: (entry[0] == "blob", entry[2] if entry[0] == "blob" else ""),
+    )
+
+    sha = hashlib.sha1()
+    offsets = {}
+    window = []
+
+    def write(data):
+        sha.update(data)
+        out.write(data)
+
+    write(_HEADER.pack(PACK_SIGNATURE, VERSION, len(objects)))
+    offset = _HEADER.size
+    for type_, obj_id, _ in objects:
+        offsets[obj_id] = offset
+        if type_ == "blob" and iter_object:
+            chunks = iter(iter_object(obj_id))
+            head, size = [], 0
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size > DELTA_MAX_SIZE:
+                    break
+            if size > DELTA_MAX_SIZE:
+                offset += _write_entry_stream(
+                    write, TYPES[type_], itertools.chain(head, chunks)
+                )
+                continue
+            data = b"".join(head)
+        else:
+            data_type, data = read_object(obj_id)
+            assert data_type == type_, f"Expected {type_}, got {data_type}"
+
+        entry_type, base_offset, payload, depth = TYPES[type_], None, data, 0
+        if deltas and type_ == "blob" and len(data) <= DELTA_MAX_SIZE:
+            for base in window:
+                if base.depth >= DELTA_DEPTH:
+                    continue
+                delta = create_delta(base.data, data, base.lines)
+                if len(delta) < min(len(payload), len(data) // 2):
+                    entry_type, base_offset = DELTA, base.offset
+                    payload, depth = delta, base.depth + 1
+            lines = _index_lines(data)
+            window.insert(0, _DeltaBase(offset, data, depth, lines))
+            del window[DELTA_WINDOW:]
+
+        compressed = zlib.compress(payload)
+        entry = _ENTRY.pack(entry_type, len(compressed))
+        if base_offset is not None:
+            entry += _OFFSET.pack(base_offset)
+        write(entry)
+        write(compressed)
+        offset += len(entry) + len(compressed)
+
+    checksum = sha.digest()
+    out.write(checksum)
+    return offsets, checksum
+
+
+def _write_entry_stream(write, entry_type, chunks):
+    # The entry header holds the compressed size, so the data is compressed
+    # into a temp file first. Returns the size of the entry
+    compressor = zlib.compressobj()
+    with tempfile.TemporaryFile() as spool:
+        for chunk in chunks:
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        size = spool.tell()
+        write(_ENTRY.pack(entry_type, size))
+        spool.seek(0)
+        while True:
+            data = spool.read(CHUNK_SIZE)
+            if not data:
+                break
+            write(data)
+    return _ENTRY.size + size
+
+
+def write_pack(pack_dir, objects, read_object, deltas=True, iter_object=None):
+    os.makedirs(pack_dir, exist_ok=True)
+    fd, tmp_path = files.make_temp_file(pack_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            offsets, checksum = write_pack_stream(
+                out, objects, read_object, deltas, iter_object
+            )
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return _install_pack(pack_dir, tmp_path, offsets, checksum)
+
+
+def index_pack(pack_dir, tmp_path):
+    # Adds a pack received without its index, e.g. from a bundle: checks it
+    # and finds every object's id in one pass over its entries
+    try:
+        with open(tmp_path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offsets, checksum = _scan_pack(data)
+        finally:
+            data.close()
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return _install_pack(pack_dir, tmp_path, offsets, checksum)
+
+
+def _scan_pack(data):
+    signature, version, count = _HEADER.unpack_from(data)
+    assert signature == PACK_SIGNATURE, "Not a pack"
+    assert version == VERSION, f"Unsupported pack version {version}"
+    checksum = data[-20:]
+    sha = hashlib.sha1()
+    for start in range(0, len(data) - 20, CHUNK_SIZE):
+        sha.update(data[start : min(start + CHUNK_SIZE, len(data) - 20)])
+    assert sha.digest() == checksum, "Corrupt pack"
+
+    offsets = {}
+    offset = _HEADER.size
+    for _ in range(count):
+        type_, chunks = _iter_entry(data, offset)
+        obj_sha = hashlib.sha1(type_.encode() + b"\x00")
+        for chunk in chunks:
+            obj_sha.update(chunk)
+        offsets[obj_sha.hexdigest()] = offset
+
+        entry_type, size = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size + size
+        if entry_type == DELTA:
+            offset += _OFFSET.size
+    assert offset == len(data) - 20, "Corrupt pack"
+    return offsets, checksum
+
+
+def _install_pack(pack_dir, tmp_path, offsets, checksum):
+    name = f"pack-{checksum.hex()}"
+    os.replace(tmp_path, f"{pack_dir}/{name}.pack")
+    write_index(f"{pack_dir}/{name}.idx", offsets, checksum)
+    # The directory mtime may not have ticked, don't rely on it
+    forget_packs(pack_dir)
+    return name
+
+
+def write_index(idx_path, offsets, checksum):
+    ids = sorted(bytes.fromhex(obj_id) for obj_id in offsets)
+    fanout = [0] * 256
+    for raw_id in ids:
+        fanout[raw_id[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    fd, tmp_path = files.make_temp_file(os.path.dirname(idx_path))
+    with os.fdopen(fd, "wb") as out:
+        out.write(_HEADER.pack(INDEX_SIGNATURE, VERSION, len(ids)))
+        out.write(_FANOUT.pack(*fanout))
+        out.write(b"".join(ids))
+        out.write(b"".join(_OFFSET.pack(offsets[raw_id.hex()]) for raw_id in ids))
+        out.write(checksum)
+    os.replace(tmp_path, idx_path)
+
+
+class Pack:
+    def __init__(self, path):
+        self.path = path
+        with open(f"{path}.idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(f"{path}.pack", "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, self.count = _HEADER.unpack_from(self.idx)
+        assert signature == INDEX_SIGNATURE, f"Not a pack index: {path}.idx"
+        assert version == VERSION, f"Unsupported pack index version {version}"
+        self.fanout = _FANOUT.unpack_from(self.idx, _HEADER.size)
+        self.offsets_start = _IDS_START + 20 * self.count
+
+    def _id_at(self, i):
+        start = _IDS_START + 20 * i
+        return self.idx[start : start + 20]
+
+    def find(self, obj_id):
+        raw_id = bytes.fromhex(obj_id)
+        lo = self.fanout[raw_id[0] - 1] if raw_id[0] else 0
+        hi = self.fanout[raw_id[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id_at(mid) < raw_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._id_at(lo) == raw_id:
+            return _OFFSET.unpack_from(self.idx, self.offsets_start + 8 * lo)[0]
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._id_at(i).hex()
+
+    def read(self, offset):
+        return _read_entry(self.data, offset)
+
+    def iter_read(self, offset):
+        return _iter_entry(self.data, offset)
+
+    def close(self):
+        self.idx.close()
+        self.data.close()
+
+
+def _read_entry(data, offset):
+    entry_type, size = _ENTRY.unpack_from(data, offset)
+    if entry_type != DELTA:
+        offset += _ENTRY.size
+        return TYPE_NAMES[entry_type], zlib.decompress(data[offset : offset + size])
+
+    (base_offset,) = _OFFSET.unpack_from(data, offset + _ENTRY.size)
+    # Bases always come first, which also rules out delta cycles
+    assert base_offset < offset, "Corrupt delta base"
+    offset += _ENTRY.size + _OFFSET.size
+    type_, base = _read_entry(data, base_offset)
+    delta = zlib.decompress(data[offset : offset + size])
+    return type_, apply_delta(base, delta)
+
+
+def _iter_entry(data, offset):
+    # The type and the content in chunks. Deltas are only made of objects
+    # up to DELTA_MAX_SIZE, so those are resolved whole
+    entry_type, size = _ENTRY.unpack_from(data, offset)
+    if entry_type == DELTA:
+        type_, content = _read_entry(data, offset)
+        return type_, iter([content])
+    start = offset + _ENTRY.size
+    return TYPE_NAMES[entry_type], _iter_inflated(data, start, start + size)
+
+
+def _iter_inflated(data, start, end):
+    # Each output chunk is capped too, a small compressed piece can inflate
+    # to many times CHUNK_SIZE
+    decompressor = zlib.decompressobj()
+    while start < end or decompressor.unconsumed_tail:
+        chunk = decompressor.unconsumed_tail
+        if not chunk:
+            chunk = data[start : min(start + CHUNK_SIZE, end)]
+            start += len(chunk)
+        content = decompressor.decompress(chunk, CHUNK_SIZE)
+        if content:
+            yield content
+    content = decompressor.flush()
+    if content:
+        yield content
+
+
+_packs = {}
+
+
+def get_packs(pack_dir):
+    # Reopen the packs whenever the directory changes, e.g. after a gc
+    try:
+        mtime = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    key = os.path.abspath(pack_dir)
+    cached = _packs.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    packs = [
+        Pack(f"{pack_dir}/{filename[:-4]}")
+        for filename in sorted(os.listdir(pack_dir))
+        if filename.endswith(".idx")
+    ]
+    _packs[key] = (mtime, packs)
+    return packs
+
+
+def forget_packs(pack_dir):
+    # Makes the next get_packs list the directory again. The packs already
+    # open stay mapped for whoever still reads them, until they are collected
+    _packs.pop(os.path.abspath(pack_dir), None)
+
+
+def close_packs(pack_dir):
+    _, packs = _packs.pop(os.path.abspath(pack_dir), (None, []))
+    for pack in packs:
+        pack.close()
+
+
+def find_object(pack_dir, obj_id):
+    for pack in get_packs(pack_dir):
+        offset = pack.find(obj_id)
+        if offset is not None:
+            return pack, offset
+    return None
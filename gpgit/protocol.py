@@ -0,0 +1,239 @@
+import os
+import socket
+import struct
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from . import files
+from . import pack
+
+# gpgit://host:port talks to a gp-git serve over TCP, gpgit:///path over a
+# Unix socket. Every message is a frame: type, payload length, payload
+URL_SCHEME = "gpgit://"
+
+REFS = 1  # prefix; answered with REFS: one record per ref
+HAVE = 2  # ids; answered with HAVE: one byte per id, 1 if it is there
+FETCH = 3  # see fetch
+OBJECTS = 4  # ids; answered with a pack of the ones there, then END
+PUSH = 5  # old id, new id, ref name; followed by a pack, answered with END
+DATA = 6  # a piece of a pack
+END = 7
+ERROR = 8  # message; ends the request
+
+CHUNK_SIZE = 1 << 20
+NO_ID = b"\x00" * 20
+
+_FRAME = struct.Struct(">BI")
+_REF = struct.Struct(">20sH")
+_FETCH = struct.Struct(">BIII")
+_PUSH = struct.Struct(">20s20s")
+
+
+def is_url(path):
+    return path.startswith(URL_SCHEME)
+
+
+def parse_url(url):
+    # A (host, port) address for TCP or a socket path
+    parts = urlsplit(url)
+    if parts.netloc:
+        return parts.hostname, parts.port
+    return parts.path
+
+
+class Connection:
+    def __init__(self, url):
+        address = parse_url(url)
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.reader = self.sock.makefile("rb")
+        # One request at a time; each runs to its END before the next starts
+        self.lock = threading.Lock()
+
+    def send(self, type_, payload=b""):
+        self.sock.sendall(_FRAME.pack(type_, len(payload)) + payload)
+
+    def receive(self):
+        return read_frame(self.reader)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def read_frame(reader):
+    header = reader.read(_FRAME.size)
+    if not header:
+        return None, b""
+    assert len(header) == _FRAME.size, "Connection closed mid-frame"
+    type_, length = _FRAME.unpack(header)
+    payload = reader.read(length)
+    assert len(payload) == length, "Connection closed mid-frame"
+    return type_, payload
+
+
+class FrameWriter:
+    # File-like object that sends what is written as DATA frames
+    def __init__(self, send):
+        self.send = send
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.send(DATA, bytes(self.buffer))
+            self.buffer.clear()
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def connect(url):
+    # Connections are kept open and reused for every later request
+    with _connections_lock:
+        connection = _connections.get(url)
+        if connection is None:
+            connection = _connections[url] = Connection(url)
+        return connection
+
+
+@contextmanager
+def _request(url):
+    # A request that fails half way leaves the connection in an unknown
+    # state, so the next one starts on a new connection
+    connection = connect(url)
+    with connection.lock:
+        try:
+            yield connection
+        except BaseException:
+            with _connections_lock:
+                if _connections.get(url) is connection:
+                    del _connections[url]
+            connection.close()
+            raise
+
+
+def close_connections():
+    with _connections_lock:
+        for connection in _connections.values():
+            connection.close()
+        _connections.clear()
+
+
+def _expect(connection, expected):
+    type_, payload = connection.receive()
+    assert type_ is not None, "Server closed the connection"
+    assert type_ != ERROR, payload.decode()
+    assert type_ == expected, f"Unexpected frame {type_}"
+    return payload
+
+
+def encode_refs(refs):
+    records = []
+    for refname, value in sorted(refs.items()):
+        name = refname.encode()
+        records.append(_REF.pack(bytes.fromhex(value), len(name)) + name)
+    return b"".join(records)
+
+
+def decode_refs(payload):
+    refs = {}
+    pos = 0
+    while pos < len(payload):
+        value, length = _REF.unpack_from(payload, pos)
+        pos += _REF.size
+        refs[payload[pos : pos + length].decode()] = value.hex()
+        pos += length
+    return refs
+
+
+def encode_ids(obj_ids):
+    return b"".join(bytes.fromhex(obj_id) for obj_id in obj_ids)
+
+
+def decode_ids(payload):
+    return [payload[i : i + 20].hex() for i in range(0, len(payload), 20)]
+
+
+def get_refs(url, prefix=""):
+    with _request(url) as connection:
+        connection.send(REFS, prefix.encode())
+        return decode_refs(_expect(connection, REFS))
+
+
+def has_objects(url, obj_ids):
+    with _request(url) as connection:
+        connection.send(HAVE, encode_ids(obj_ids))
+        return [bool(has) for has in _expect(connection, HAVE)]
+
+
+def fetch(url, wants, haves, pack_dir, depth=None, blobs=True):
+    # haves are saves that are here with their whole history. The server
+    # walks down from wants to the saves they reach and sends a pack of
+    # what is missing, with no questions on the way. END carries the saves
+    # whose parents a depth left out
+    with _request(url) as connection:
+        wants, haves = list(wants), list(haves)
+        connection.send(
+            FETCH,
+            _FETCH.pack(blobs, depth or 0, len(wants), len(haves))
+            + encode_ids(wants + haves),
+        )
+        return _receive_pack(connection, pack_dir)
+
+
+def fetch_objects(url, obj_ids, pack_dir):
+    with _request(url) as connection:
+        connection.send(OBJECTS, encode_ids(obj_ids))
+        name, _ = _receive_pack(connection, pack_dir)
+    return name
+
+
+def push(url, refname, old, new, write_pack):
+    # write_pack writes a pack stream to the file it is given
+    with _request(url) as connection:
+        old = bytes.fromhex(old) if old else NO_ID
+        connection.send(PUSH, _PUSH.pack(old, bytes.fromhex(new)) + refname.encode())
+        writer = FrameWriter(connection.send)
+        write_pack(writer)
+        writer.flush()
+        connection.send(END)
+        _expect(connection, END)
+
+
+def _receive_pack(connection, pack_dir):
+    # Returns the name of the new pack, or None if it was empty, and the
+    # ids sent with END
+    os.makedirs(pack_dir, exist_ok=True)
+    fd, tmp_path = files.make_temp_file(pack_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                type_, payload = connection.receive()
+                if type_ != DATA:
+                    break
+                out.write(payload)
+        assert type_ is not None, "Server closed the connection"
+        assert type_ != ERROR, payload.decode()
+        assert type_ == END, f"Unexpected frame {type_}"
+        return receive_pack_file(pack_dir, tmp_path), decode_ids(payload)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def receive_pack_file(pack_dir, tmp_path):
+    # Indexes a pack that came over a connection, unless it has no objects
+    with open(tmp_path, "rb") as f:
+        header = f.read(pack._HEADER.size)
+    if len(header) == pack._HEADER.size and pack._HEADER.unpack(header)[2]:
+        return pack.index_pack(pack_dir, tmp_path)
+    os.remove(tmp_path)
+    return None
@@ -1,17 +1,74 @@
 import os
+import struct
 from . import base
 from . import files
+from . import pack
+from . import protocol
+from . import transfer
 
 
 REMOTE_REFS_BASE = 'refs/heads/'
 LOCAL_REFS_BASE = 'refs/remote/'
 
+# Bundle: header, then one record per ref, then a pack
+#   ref: save id, name length, name
+BUNDLE_SIGNATURE = b'GPBN'
+BUNDLE_VERSION = 1
 
-def download(remote_path):
+_BUNDLE_HEADER = struct.Struct('>4sII')
+_BUNDLE_REF = struct.Struct('>20sH')
+
+
+def download(remote_path, shared=False, jobs=None, progress=None,
+             depth=None, filter=None):
+    # depth leaves out saves more than that many below the remote branches,
+    # and filter='blob:none' leaves out blobs until they are needed, when
+    # they are fetched from the remote again
+    assert filter in (None, 'blob:none'), f'Unknown filter {filter}'
+    assert depth is None or depth > 0, 'depth must be positive'
+    # remote_path may also be the gpgit:// URL of a gp-git serve
+    served = protocol.is_url(remote_path)
+    assert not (served and shared), 'A served remote cannot be shared'
     refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+    local_path = _local_path()
+    if filter:
+        files.set_config('promisor',
+                         remote_path if served else os.path.abspath(remote_path))
+    if shared:
+        # Borrow the remote's objects instead of copying them; they must
+        # not be deleted from there
+        with files.change_git_dir(remote_path):
+            objects_dir = f'{files.get_git_dir()}/objects'
+        files.add_alternate(objects_dir)
+
+    # A history cut short by an earlier download --depth is filled in too,
+    # or made as deep as depth asks
+    def local_has(obj_id):
+        with files.change_git_dir(local_path):
+            return base.has_full_history(obj_id)
+
+    if served:
+        # The server is told up front which tips are here, rather than
+        # asking about each save it walks
+        haves = {ref.value for _, ref in files.iter_refs()
+                 if ref.value and local_has(ref.value)}
+        _, shallow = protocol.fetch(remote_path, refs.values(), haves,
+                                    files._pack_dir(), depth, not filter)
+    else:
+        shallow = set()
 
-    for obj_id in base.iter_objects_in_saves(refs.values ()):
-        files.download_object_if_missing(obj_id, remote_path)
+        def iter_new_objects():
+            return base.iter_new_objects(refs.values(), local_has, depth=depth,
+                                         shallow=shallow, blobs=not filter)
+
+        # A shared pack would bring along the blobs left out
+        if filter or not files.same_filesystem(remote_path, local_path):
+            with files.change_git_dir(remote_path):
+                objects = list(iter_new_objects())
+            files.transfer_objects(objects, remote_path, local_path, share=False)
+        else:
+            _share_objects(remote_path, iter_new_objects, jobs, progress)
+    base.update_shallow(shallow)
 
     # Update local refs to match server
     for remote_name, value in refs.items():
@@ -20,6 +77,25 @@ def download(remote_path):
                          files.RefValue (symbolic=False, value=value))
 
 
+def _share_objects(remote_path, iter_new_objects, jobs, progress):
+    # Files are linked while the remote's trees are still being diffed. The
+    # saves come last, one at a time, see files.iter_copy_jobs
+    local_path = _local_path()
+    last = []
+
+    def iter_jobs():
+        with files.change_git_dir(remote_path):
+            yield from files.iter_copy_jobs(iter_new_objects(), local_path, last)
+
+    done = transfer.run(iter_jobs(), jobs or transfer.MAX_IN_FLIGHT,
+                        progress=progress)
+
+    def last_progress(last_done, last_started):
+        progress(done + last_done, done + last_started)
+
+    transfer.run(last, 1, progress=progress and last_progress)
+
+
 def throw(remote_path, refname):
     remote_refs = _get_remote_refs(remote_path)
     remote_ref = remote_refs.get(refname)
@@ -28,19 +104,87 @@ def throw(remote_path, refname):
     assert local_ref
     assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref)
 
-    known_remote_refs = filter(files.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_saves(known_remote_refs))
-    local_objects = set(base.iter_objects_in_saves({local_ref}))
-    objects_to_throw = local_objects - remote_objects
+    if protocol.is_url(remote_path):
+        _throw_to_server(remote_path, refname, remote_ref, local_ref)
+        return
+
+    # Like download, a history an interrupted throw left incomplete is
+    # filled in
+    def remote_has(obj_id):
+        with files.change_git_dir(remote_path):
+            return base.has_full_history(obj_id)
 
-    for obj_id in objects_to_throw:
-        files.throw_object(obj_id, remote_path)
+    objects = base.iter_new_objects({local_ref}, remote_has)
+    files.transfer_objects(objects, _local_path(), remote_path)
 
     with files.change_git_dir(remote_path):
         files.update_ref(refname,
-                         files.RefValue (symbolic=False, value=local_ref))
+                         files.RefValue (symbolic=False, value=local_ref),
+                         expected_old=remote_ref or '')
+
+
+def _throw_to_server(url, refname, remote_ref, local_ref):
+    def remote_has(obj_id):
+        return protocol.has_objects(url, [obj_id])[0]
+
+    # Negotiated before the push starts, which holds the connection
+    objects = list(base.iter_new_objects({local_ref}, remote_has))
+
+    def write_pack(out):
+        pack.write_pack_stream(out, objects, files._read_object,
+                               iter_object=files.iter_object)
+
+    protocol.push(url, refname, remote_ref, local_ref, write_pack)
+
+
+def create_bundle(path, refnames, deltas=True):
+    refs = {refname: files.get_ref(refname).value for refname in refnames}
+    for refname, value in refs.items():
+        assert value, f'Unknown ref {refname}'
+    objects = base._iter_typed_objects_in_saves(set(refs.values()))
+
+    with open(path, 'wb') as out:
+        out.write(_BUNDLE_HEADER.pack(BUNDLE_SIGNATURE, BUNDLE_VERSION, len(refs)))
+        for refname, value in sorted(refs.items()):
+            name = refname.encode()
+            out.write(_BUNDLE_REF.pack(bytes.fromhex(value), len(name)) + name)
+        offsets, _ = pack.write_pack_stream(
+            out, objects, files._read_object, deltas, files.iter_object)
+    return refs, len(offsets)
+
+
+def unbundle(path):
+    # Stores the bundle's objects as a pack and returns its refs, which are
+    # left for the caller to use
+    pack_dir = files._pack_dir()
+    os.makedirs(pack_dir, exist_ok=True)
+    with open(path, 'rb') as f:
+        signature, version, count = _BUNDLE_HEADER.unpack(
+            f.read(_BUNDLE_HEADER.size))
+        assert signature == BUNDLE_SIGNATURE, f'Not a bundle: {path}'
+        assert version == BUNDLE_VERSION, f'Unsupported bundle version {version}'
+        refs = {}
+        for _ in range(count):
+            value, length = _BUNDLE_REF.unpack(f.read(_BUNDLE_REF.size))
+            refs[f.read(length).decode()] = value.hex()
+
+        fd, tmp_path = files.make_temp_file(pack_dir)
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = f.read(files.CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+    pack.index_pack(pack_dir, tmp_path)
+    return refs
+
+
+def _local_path():
+    return os.path.dirname(files.get_git_dir())
 
 
 def _get_remote_refs(remote_path, prefix=''):
+    if protocol.is_url(remote_path):
+        return protocol.get_refs(remote_path, prefix)
     with files.change_git_dir(remote_path):
         return {refname: ref.value for refname, ref in files.iter_refs(prefix)}
@@ -0,0 +1,107 @@
+import contextvars
+import functools
+import inspect
+from contextlib import contextmanager
+from . import base
+from . import compare
+from . import files
+from . import graph
+from . import pack
+from . import remote
+
+
+def _method(function):
+    # Runs function with the repository current in a context of its own, so
+    # neither the caller nor other threads see it switch. A generator is
+    # resumed in that same context each time
+    @functools.wraps(function)
+    def method(self, *args, **kwargs):
+        context = contextvars.copy_context()
+        context.run(files.use_git_dir, self.git_dir)
+        result = context.run(function, *args, **kwargs)
+        if inspect.isgenerator(result):
+            return _iter_in_context(context, result)
+        return result
+
+    return method
+
+
+def _iter_in_context(context, iterator):
+    while True:
+        try:
+            item = context.run(next, iterator)
+        except StopIteration:
+            return
+        yield item
+
+
+class Repository:
+    # A repository to work on without making it the current one, e.g. from
+    # the threads of a server hosting many. The caches (objects, parsed
+    # trees and saves, packs, commit graph, refs) are shared by the whole
+    # process but kept apart per repository, so they stay warm from one use
+    # to the next, until close. Only what lives in the .gpgit directory is
+    # here: commands that read or write the working tree (track, switch,
+    # combine, read-tree, diffs against the working tree) work on the
+    # current directory, which the whole process shares, so they are left
+    # out
+    def __init__(self, path="."):
+        self.path = path
+        self.git_dir = f"{path}/.gpgit"
+
+    def __repr__(self):
+        return f"Repository({self.path!r})"
+
+    @contextmanager
+    def current(self):
+        # For what isn't a method, e.g. files.get_index()
+        with files.change_git_dir(self.path):
+            yield self
+
+    def close(self):
+        # Drops its entries from the caches, its packs included, which are
+        # unmapped once nothing reads them. It can be used again afterwards,
+        # starting cold
+        with self.current():
+            pack.forget_packs(files._pack_dir())
+            graph.close()
+            files.clear_caches()
+
+    # files
+    get_config = _method(files.get_config)
+    set_config = _method(files.set_config)
+    get_ref = _method(files.get_ref)
+    update_ref = _method(files.update_ref)
+    delete_ref = _method(files.delete_ref)
+    iter_refs = _method(files.iter_refs)
+    pack_refs = _method(files.pack_refs)
+    fingerprint = _method(files.fingerprint)
+    get_object = _method(files.get_object)
+    iter_object = _method(files.iter_object)
+    object_exists = _method(files.object_exists)
+
+    # base
+    start = _method(base.start)
+    write_tree = _method(base.write_tree)
+    get_tree = _method(base.get_tree)
+    save = _method(base.save)
+    get_save = _method(base.get_save)
+    reset = _method(base.reset)
+    get_combine_base = _method(base.get_combine_base)
+    is_ancestor_of = _method(base.is_ancestor_of)
+    create_branch = _method(base.create_branch)
+    create_label = _method(base.create_label)
+    iter_branch_names = _method(base.iter_branch_names)
+    iter_saves_and_parents = _method(base.iter_saves_and_parents)
+    iter_tree_changes = _method(base.iter_tree_changes)
+    get_obj_id = _method(base.get_obj_id)
+    pack_objects = _method(base.pack_objects)
+
+    # compare
+    compare_trees = _method(compare.compare_trees)
+
+    # remote
+    download = _method(remote.download)
+    throw = _method(remote.throw)
+    create_bundle = _method(remote.create_bundle)
+    unbundle = _method(remote.unbundle)
@@ -0,0 +1,180 @@
+import os
+import socketserver
+import threading
+from . import base
+from . import files
+from . import pack
+from . import protocol
+
+# gp-git serve: one long-running process per repository, so its open packs,
+# commit graph, object caches and ref table stay loaded between requests.
+# Each connection gets a thread, which starts with this repository current
+
+
+class _RefTable:
+    # Writing a ref renames a file into its directory, which always changes
+    # the directory's mtime, so the refs are only reread after that
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key = None
+        self.refs = {}
+
+    def get(self):
+        key = _refs_key()
+        with self.lock:
+            if key != self.key:
+                self.refs = {name: ref.value for name, ref in files.iter_refs()}
+                self.key = key
+            return self.refs
+
+
+def _refs_key():
+    git_dir = files.get_git_dir()
+    key = []
+    for dirpath, _, _ in os.walk(f"{git_dir}/refs"):
+        key.append((dirpath, os.stat(dirpath).st_mtime_ns))
+    for path in (git_dir, f"{git_dir}/packed-refs"):
+        try:
+            stat = os.stat(path)
+            key.append((path, stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        except FileNotFoundError:
+            pass
+    return tuple(key)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        files.use_git_dir(self.server.git_dir)
+        handlers = {
+            protocol.REFS: self.send_refs,
+            protocol.HAVE: self.send_have,
+            protocol.FETCH: self.send_fetch,
+            protocol.OBJECTS: self.send_objects,
+            protocol.PUSH: self.receive_push,
+        }
+        while True:
+            type_, payload = protocol.read_frame(self.rfile)
+            if type_ is None:
+                return
+            try:
+                handler = handlers.get(type_)
+                assert handler, f"Unknown request {type_}"
+                handler(payload)
+            except (AssertionError, FileNotFoundError) as e:
+                self.send(protocol.ERROR, str(e).encode())
+
+    def send(self, type_, payload=b""):
+        self.wfile.write(protocol._FRAME.pack(type_, len(payload)) + payload)
+        self.wfile.flush()
+
+    def send_refs(self, payload):
+        prefix = payload.decode()
+        refs = self.server.refs.get()
+        refs = {name: value for name, value in refs.items() if name.startswith(prefix)}
+        self.send(protocol.REFS, protocol.encode_refs(refs))
+
+    def send_have(self, payload):
+        obj_ids = protocol.decode_ids(payload)
+        has = bytes(files.object_exists(obj_id) for obj_id in obj_ids)
+        self.send(protocol.HAVE, has)
+
+    def send_fetch(self, payload):
+        blobs, depth, want_count, have_count = protocol._FETCH.unpack_from(payload)
+        obj_ids = protocol.decode_ids(payload[protocol._FETCH.size :])
+        assert len(obj_ids) == want_count + have_count, "Corrupt fetch request"
+        wants, haves = obj_ids[:want_count], obj_ids[want_count:]
+        # Saves the client has that aren't here can't stop the walk anyway
+        has_save = base.reachable_from(
+            obj_id for obj_id in haves if files.object_exists(obj_id)
+        )
+
+        shallow = set()
+        objects = list(
+            base.iter_new_objects(
+                wants, has_save, depth=depth or None, shallow=shallow, blobs=blobs
+            )
+        )
+        self.send_pack(objects)
+        self.send(protocol.END, protocol.encode_ids(sorted(shallow)))
+
+    def send_objects(self, payload):
+        objects = []
+        for obj_id in protocol.decode_ids(payload):
+            if files.object_exists(obj_id):
+                type_, _ = files._read_object(obj_id)
+                objects.append((type_, obj_id, ""))
+        self.send_pack(objects)
+        self.send(protocol.END)
+
+    def send_pack(self, objects):
+        writer = protocol.FrameWriter(self.send)
+        pack.write_pack_stream(
+            writer, objects, files._read_object, iter_object=files.iter_object
+        )
+        writer.flush()
+
+    def receive_push(self, payload):
+        old, new = protocol._PUSH.unpack_from(payload)
+        refname = payload[protocol._PUSH.size :].decode()
+        pack_dir = files._pack_dir()
+        os.makedirs(pack_dir, exist_ok=True)
+        fd, tmp_path = files.make_temp_file(pack_dir)
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                type_, data = protocol.read_frame(self.rfile)
+                if type_ != protocol.DATA:
+                    break
+                out.write(data)
+        # Checked once the pack is read, so the connection stays usable
+        if type_ != protocol.END or not _is_branch_name(refname):
+            os.remove(tmp_path)
+        assert type_ == protocol.END, "Push ended before its pack"
+        assert _is_branch_name(refname), f"Invalid branch name {refname!r}"
+        protocol.receive_pack_file(pack_dir, tmp_path)
+
+        old = "" if old == protocol.NO_ID else old.hex()
+        files.update_ref(
+            refname, files.RefValue(symbolic=False, value=new.hex()), expected_old=old
+        )
+        self.send(protocol.END)
+
+
+def _is_branch_name(refname):
+    # Pushes only move branches, and the name becomes a path in the served
+    # repository, so it must stay under refs/heads/
+    parts = refname.split("/")
+    return (
+        len(parts) > 2
+        and parts[:2] == ["refs", "heads"]
+        and "\0" not in refname
+        and all(part not in ("", ".", "..") for part in parts)
+        and not refname.endswith(".lock")
+    )
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address):
+    # Serves the current repository at address, a socket path or a (host,
+    # port) pair. The server is bound but not started yet
+    if isinstance(address, str):
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(address, _Handler)
+    server.git_dir = files.get_git_dir()
+    server.refs = _RefTable()
+    return server
+
+
+def get_url(server):
+    if isinstance(server.server_address, str):
+        return f"{protocol.URL_SCHEME}{os.path.abspath(server.server_address)}"
+    host, port = server.server_address
+    return f"{protocol.URL_SCHEME}{host}:{port}"
@@ -0,0 +1,102 @@
+import asyncio
+import contextvars
+import errno
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_IN_FLIGHT = 16
+RETRIES = 3
+RETRY_DELAY = 0.05
+
+# Errors a slow or flaky network filesystem may give for an operation that
+# can succeed if tried again
+TRANSIENT_ERRORS = {
+    errno.EAGAIN,
+    errno.EINTR,
+    errno.EIO,
+    errno.ETIMEDOUT,
+    getattr(errno, "ESTALE", errno.EIO),
+}
+
+
+def run(jobs, max_in_flight=MAX_IN_FLIGHT, retries=RETRIES, progress=None):
+    # Runs blocking jobs (callables) with at most max_in_flight of them at
+    # once. `jobs` may itself block, e.g. while walking a remote, and is
+    # drained alongside the jobs already started. progress is called with
+    # the number of jobs done and started so far
+    jobs = iter(jobs)
+    # Pool threads don't share the caller's context variables, e.g. the
+    # current repository. The jobs iterator keeps one context across all its
+    # steps, since it may switch repositories between them
+    jobs_context = contextvars.copy_context()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _run(loop, jobs, jobs_context, max_in_flight, retries, progress)
+        )
+    finally:
+        loop.close()
+        # Lets a generator that stopped early leave the contexts it entered
+        close = getattr(jobs, "close", None)
+        if close:
+            jobs_context.run(close)
+
+
+async def _run(loop, jobs, jobs_context, max_in_flight, retries, progress):
+    # One extra thread pulls the next job while max_in_flight jobs run
+    with ThreadPoolExecutor(max_in_flight + 1) as executor:
+        slots = asyncio.Semaphore(max_in_flight)
+        running = set()
+        started = done = 0
+
+        async def run_job(job):
+            try:
+                for attempt in range(retries + 1):
+                    try:
+                        context = contextvars.copy_context()
+                        return await loop.run_in_executor(executor, context.run, job)
+                    except OSError as e:
+                        if e.errno not in TRANSIENT_ERRORS or attempt == retries:
+                            raise
+                    await asyncio.sleep(RETRY_DELAY * 2**attempt)
+            finally:
+                slots.release()
+
+        try:
+            while True:
+                job = await loop.run_in_executor(
+                    executor, jobs_context.run, next, jobs, None
+                )
+                if job is None:
+                    break
+                await slots.acquire()
+                # Stop at the first failure instead of starting more jobs
+                for task in [task for task in running if task.done()]:
+                    running.discard(task)
+                    task.result()
+                    done += 1
+                    if progress:
+                        progress(done, started)
+                running.add(loop.create_task(run_job(job)))
+                started += 1
+
+            for task in asyncio.as_completed(running):
+                await task
+                done += 1
+                if progress:
+                    progress(done, started)
+        except BaseException:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+    return done
+
+
+def with_latency(job, latency):
+    # For benchmarks: a job that waits like a round trip to a slow remote
+    def delayed():
+        time.sleep(latency)
+        return job()
+
+    return delayed
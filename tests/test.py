@@ -1,7 +1,14 @@
 import unittest
+import errno
 import os
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from gpgit import base, compare, files, graph, pack, protocol, remote, transfer
+from gpgit.repository import Repository
 from gpgit.files import object_exists, fingerprint, get_object
 
 class TestFiles(unittest.TestCase):
@@ -15,11 +22,1448 @@ class TestFiles(unittest.TestCase):
         obj_id = fingerprint(data)
         self.assertEqual(len(obj_id), 40)  # SHA-1 hash length
 
+    def test_fingerprint_outside_a_repository_writes_nothing(self):
+        old_cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                fingerprint(b'test data')
+                with open('file', 'wb') as f:
+                    f.write(b'test data')
+                file_id = files.fingerprint_file('file')
+                self.assertEqual(os.listdir('.'), ['file'])
+            finally:
+                os.chdir(old_cwd)
+        self.assertEqual(file_id, fingerprint(b'test data'))
+
     def test_get_object(self):
         obj_id = 'some_existing_object_id'
         obj = get_object(obj_id)
         self.assertIsNotNone(obj)
         self.assertEqual(obj.type, 'blob')
 
+
+class RepoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.git_dir = files.change_git_dir('.')
+        self.git_dir.__enter__()
+        base.start()
+
+    def tearDown(self):
+        self.git_dir.__exit__(None, None, None)
+        os.chdir(self.old_cwd)
+        self.tmp.cleanup()
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(f'./{path}'), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+class TestStatCache(RepoTestCase):
+
+    def test_track_fills_stat_cache(self):
+        self.write('a.txt', b'hello\n')
+        base.track(['a.txt'])
+        with files.get_index() as index:
+            obj_id, stat = index.stats['a.txt']
+        self.assertEqual(obj_id, index['a.txt'])
+        self.assertEqual(stat, files.stat_path('a.txt'))
+
+    def test_working_tree_uses_cached_id(self):
+        self.write('a.txt', b'hello\n')
+        base.track(['a.txt'])
+        with files.get_index() as index:
+            stat = files.stat_path('a.txt')
+            index.stats['a.txt'] = ('0' * 40, stat)
+            index.timestamp = stat.mtime_ns
+            self.assertTrue(index.is_racy(stat))
+            self.assertIsNone(index.get_cached_obj_id('a.txt', stat))
+            index.timestamp = stat.mtime_ns + 1
+            self.assertEqual(index.get_cached_obj_id('a.txt', stat), '0' * 40)
+
+    def test_stats_as_new_as_the_index_are_smudged(self):
+        self.write('a.txt', b'hello\n')
+        self.write('b.txt', b'hello\n')
+        now = time.time_ns()
+        os.utime('a.txt', ns=(now - 10**10, now - 10**10))
+        os.utime('b.txt', ns=(now + 10**10, now + 10**10))
+        base.track(['a.txt', 'b.txt'])
+        with files.read_index() as index:
+            self.assertEqual(index.get_stat('a.txt')[1], files.stat_path('a.txt'))
+            self.assertIsNone(index.get_stat('b.txt'))
+
+    def test_modified_file_is_rehashed(self):
+        self.write('a.txt', b'hello\n')
+        base.track(['a.txt'])
+        self.write('a.txt', b'changed, and longer\n')
+        with open('a.txt', 'rb') as f:
+            expected = fingerprint(f.read())
+        self.assertEqual(base.get_working_tree()['a.txt'], expected)
+
+    def test_old_index_format(self):
+        with open('.gpgit/index', 'w') as f:
+            f.write('{"a.txt": "%s"}' % ('1' * 40))
+        with files.get_index() as index:
+            self.assertEqual(index, {'a.txt': '1' * 40})
+            self.assertEqual(index.stats, {})
+
+
+class TestBinaryIndex(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ('b.txt', 'a/c.txt', 'a/b.txt', 'a.txt'):
+            self.write(name, name.encode())
+        base.track(['.'])
+        base.write_tree()
+
+    def test_read_only_lookups(self):
+        with files.read_index() as index:
+            self.assertIsInstance(index, files.IndexView)
+            self.assertEqual(list(index), ['a.txt', 'a/b.txt', 'a/c.txt', 'b.txt'])
+            self.assertEqual(index['a/c.txt'], fingerprint(b'a/c.txt', write=False))
+            self.assertNotIn('a', index)
+            self.assertEqual(index.get_stat('b.txt')[1], files.stat_path('b.txt'))
+            self.assertEqual(set(index.trees), {'', 'a'})
+            self.assertEqual(index.load(), dict(index.items()))
+
+    def test_reads_do_not_rewrite_the_index(self):
+        before = os.stat('.gpgit/index')
+        base.get_index_tree()
+        base.get_working_tree()
+        with files.get_index():
+            pass
+        after = os.stat('.gpgit/index')
+        self.assertEqual(
+            (before.st_ino, before.st_mtime_ns), (after.st_ino, after.st_mtime_ns))
+
+    def test_only_stats_of_indexed_ids_are_stored(self):
+        with files.get_index() as index:
+            index.update_stat('a.txt', '0' * 40, files.stat_path('a.txt'))
+            index['b.txt'] = '1' * 40
+        with files.read_index() as index:
+            self.assertIsNone(index.get_stat('a.txt'))
+            self.assertIsNone(index.get_stat('b.txt'))
+            self.assertIsNotNone(index.get_stat('a/b.txt'))
+        self.assertEqual(
+            [name for name in os.listdir('.gpgit') if name.startswith('tmp')], [])
+
+    def test_json_index_is_converted_on_change(self):
+        with open('.gpgit/index', 'w') as f:
+            f.write('{"a.txt": "%s"}' % ('1' * 40))
+        self.assertEqual(base.get_index_tree(), {'a.txt': '1' * 40})
+        base.track(['b.txt'])
+        with files.read_index() as index:
+            self.assertEqual(index['a.txt'], '1' * 40)
+            self.assertEqual(index['b.txt'], fingerprint(b'b.txt', write=False))
+
+
+class TestHashOnly(RepoTestCase):
+
+    def test_fingerprint_without_write(self):
+        obj_id = fingerprint(b'data', write=False)
+        self.assertFalse(object_exists(obj_id))
+        self.assertEqual(fingerprint(b'data'), obj_id)
+        self.assertTrue(object_exists(obj_id))
+
+    def test_failed_write_leaves_no_object(self):
+        obj_id = fingerprint(b'data', write=False)
+        compression_level = files._compression_level
+
+        def fail():
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+        files._compression_level = fail
+        try:
+            with self.assertRaises(OSError):
+                fingerprint(b'data')
+        finally:
+            files._compression_level = compression_level
+        self.assertFalse(object_exists(obj_id))
+        self.assertEqual(os.listdir(f'.gpgit/objects/{obj_id[:2]}'), [])
+        self.assertEqual(fingerprint(b'data'), obj_id)
+        self.assertEqual(get_object(obj_id), b'data')
+
+    def test_working_tree_scan_writes_nothing(self):
+        self.write('a.txt', b'hello\n')
+        obj_id = base.get_working_tree()['a.txt']
+        self.assertFalse(object_exists(obj_id))
+        self.assertEqual(os.listdir('.gpgit/objects'), [])
+
+    def test_track_stores_blob_hashed_by_scan(self):
+        self.write('a.txt', b'hello\n')
+        base.track(['a.txt'])
+        os.remove(files._object_path(base.get_index_tree()['a.txt']))
+        base.track(['a.txt'])
+        self.assertEqual(get_object(base.get_index_tree()['a.txt']), b'hello\n')
+
+
+class TestStreaming(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.chunk_size = files.CHUNK_SIZE
+        files.CHUNK_SIZE = 7
+
+    def tearDown(self):
+        files.CHUNK_SIZE = self.chunk_size
+        super().tearDown()
+
+    def test_fingerprint_file_matches_fingerprint(self):
+        data = bytes(range(256)) * 3
+        self.write('big.bin', data)
+        obj_id = files.fingerprint_file('big.bin')
+        self.assertEqual(obj_id, fingerprint(data, write=False))
+        self.assertEqual(get_object(obj_id), data)
+        self.assertEqual(os.listdir('.gpgit/objects'), [obj_id[:2]])
+
+    def test_iter_object(self):
+        obj_id = fingerprint(b'some longer content', 'tree')
+        self.assertEqual(b''.join(files.iter_object(obj_id, 'tree')),
+                         b'some longer content')
+        with self.assertRaises(AssertionError):
+            list(files.iter_object(obj_id, 'blob'))
+
+    def test_large_blobs_are_packed_and_read_in_chunks(self):
+        limits = pack.DELTA_MAX_SIZE, pack.CHUNK_SIZE
+        pack.DELTA_MAX_SIZE, pack.CHUNK_SIZE = 100, 16
+        try:
+            data = bytes(range(256)) * 4
+            self.write('big.bin', data)
+            self.write('small.txt', b'small')
+            base.track(['.'])
+            base.save('first')
+            base.pack_objects(gc=True)
+            obj_id = base.get_index_tree()['big.bin']
+            chunks = list(files.iter_object(obj_id))
+            self.assertEqual(b''.join(chunks), data)
+            self.assertLessEqual(max(map(len, chunks)), 16)
+            self.assertEqual(get_object(obj_id), data)
+
+            os.makedirs('other')
+            with files.change_git_dir('other'):
+                base.start()
+                pack_dir = files._pack_dir()
+            files.transfer_objects([('blob', obj_id, '')], '.', 'other', share=False)
+            # Indexed again from scratch, as a received pack is
+            [name] = [name[:-4] for name in os.listdir(pack_dir)
+                      if name.endswith('.idx')]
+            tmp_path = f'{pack_dir}/tmp-copy'
+            os.rename(f'{pack_dir}/{name}.pack', tmp_path)
+            os.remove(f'{pack_dir}/{name}.idx')
+            pack.index_pack(pack_dir, tmp_path)
+            with files.change_git_dir('other'):
+                self.assertEqual(b''.join(files.iter_object(obj_id)), data)
+        finally:
+            pack.DELTA_MAX_SIZE, pack.CHUNK_SIZE = limits
+
+
+class TestCompression(RepoTestCase):
+
+    def test_objects_are_compressed(self):
+        obj_id = fingerprint(b'a' * 1000)
+        with open(files._object_path(obj_id), 'rb') as f:
+            self.assertLess(len(f.read()), 100)
+        self.assertEqual(get_object(obj_id), b'a' * 1000)
+        self.assertEqual(b''.join(files.iter_object(obj_id)), b'a' * 1000)
+
+    def test_compress_old_objects(self):
+        obj_id = fingerprint(b'raw', write=False)
+        with open(f'.gpgit/objects/{obj_id}', 'wb') as f:
+            f.write(b'blob\x00raw')
+        self.assertEqual(get_object(obj_id), b'raw')
+        self.assertEqual(files.compress_objects(), 1)
+        self.assertEqual(files.compress_objects(), 0)
+        self.assertEqual(get_object(obj_id), b'raw')
+
+    def test_compression_level(self):
+        files.set_config('compression', 0)
+        obj_id = fingerprint(b'a' * 1000)
+        with open(files._object_path(obj_id), 'rb') as f:
+            self.assertGreater(len(f.read()), 1000)
+        self.assertEqual(get_object(obj_id), b'a' * 1000)
+
+    def test_config_is_parsed_once(self):
+        files.set_config('compression', 0)
+        loads = []
+        load = files.json.load
+        files.json.load = lambda f: loads.append(f) or load(f)
+        try:
+            for i in range(3):
+                fingerprint(b'object %d' % i)
+            self.assertEqual(len(loads), 1)
+            with open('.gpgit/config', 'w') as f:
+                f.write('{"compression": 9, "workers": 2}')
+            self.assertEqual(files.get_config('compression'), 9)
+        finally:
+            files.json.load = load
+        self.assertEqual(len(loads), 2)
+
+
+class TestPack(RepoTestCase):
+
+    def save_versions(self):
+        lines = [b'line %d of a longer text file\n' % i for i in range(200)]
+        saves = []
+        for i in range(3):
+            lines[i * 50] = b'changed in version %d\n' % i
+            self.write('dir/file.txt', b''.join(lines))
+            self.write('other.txt', b'version %d\n' % i)
+            base.track(['dir', 'other.txt'])
+            saves.append(base.save(f'version {i}'))
+        return saves
+
+    def test_delta_round_trip(self):
+        source = b''.join(b'line %d\n' % i for i in range(100))
+        target = source.replace(b'line 50\n', b'something else\n') + b'tail'
+        delta = pack.create_delta(source, target)
+        self.assertLess(len(delta), len(target) // 4)
+        self.assertEqual(pack.apply_delta(source, delta), target)
+
+    def test_pack_and_read_back(self):
+        saves = self.save_versions()
+        expected = {obj_id: get_object(obj_id, None)
+                    for obj_id in base.iter_objects_in_saves({saves[-1]})}
+
+        name, count = base.pack_objects(gc=True)
+        self.assertEqual(count, len(expected))
+        self.assertEqual(sorted(os.listdir('.gpgit/objects')), ['pack'])
+        packed = pack.get_packs('.gpgit/objects/pack')[0]
+        entry_types = {packed.data[packed.find(obj_id)] for obj_id in expected}
+        self.assertIn(pack.DELTA, entry_types)
+
+        for obj_id, content in expected.items():
+            self.assertTrue(object_exists(obj_id))
+            self.assertEqual(get_object(obj_id, None), content)
+        self.assertFalse(object_exists('0' * 40))
+        self.assertEqual(base.get_save(saves[-1]).message, 'version 2')
+
+    def test_pack_takes_only_loose_objects(self):
+        saves = self.save_versions()
+        _, first_count = base.pack_objects()
+        self.assertEqual(sorted(os.listdir('.gpgit/objects')), ['pack'])
+        self.write('other.txt', b'version 3\n')
+        base.track(['other.txt'])
+        saves.append(base.save('version 3'))
+        # The new blob, root tree and save
+        self.assertEqual(base.pack_objects()[1], 3)
+        self.assertEqual(sorted(os.listdir('.gpgit/objects')), ['pack'])
+        packs = pack.get_packs('.gpgit/objects/pack')
+        self.assertEqual(sum(packed.count for packed in packs), first_count + 3)
+        self.assertEqual(base.pack_objects(), (None, 0))
+        self.assertEqual(base.get_save(saves[-1]).message, 'version 3')
+
+    def test_gc_keeps_objects_from_old_packs(self):
+        saves = self.save_versions()
+        base.pack_objects()
+        base.reset(saves[0])
+        base.pack_objects(gc=True)
+        self.assertEqual(len(os.listdir('.gpgit/objects/pack')), 2)
+        self.assertEqual(base.get_save(saves[-1]).message, 'version 2')
+
+    def test_written_files_follow_the_umask(self):
+        umask = os.umask(0o027)
+        try:
+            self.save_versions()
+            base.pack_objects(gc=True)
+            obj_id = fingerprint(b'loose')
+        finally:
+            os.umask(umask)
+        paths = ['.gpgit/index', '.gpgit/commit-graph', files._object_path(obj_id)] + [
+            f'.gpgit/objects/pack/{name}'
+            for name in os.listdir('.gpgit/objects/pack')]
+        self.assertEqual(len(paths), 5)
+        for path in paths:
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o640, path)
+
+
+class TestFanOut(RepoTestCase):
+
+    def test_objects_are_fanned_out(self):
+        obj_id = fingerprint(b'data')
+        self.assertTrue(os.path.isfile(f'.gpgit/objects/{obj_id[:2]}/{obj_id[2:]}'))
+
+    def test_flat_objects_are_read_and_migrated(self):
+        obj_id = fingerprint(b'data')
+        os.replace(files._object_path(obj_id), f'.gpgit/objects/{obj_id}')
+        self.assertTrue(object_exists(obj_id))
+        self.assertEqual(get_object(obj_id), b'data')
+        self.assertEqual(files.fan_out_objects(), 1)
+        self.assertEqual(files.fan_out_objects(), 0)
+        self.assertFalse(os.path.exists(f'.gpgit/objects/{obj_id}'))
+        self.assertEqual(get_object(obj_id), b'data')
+
+
+class TestParallelHashing(RepoTestCase):
+
+    def test_parallel_track_matches_serial(self):
+        for i in range(50):
+            self.write(f'dir{i % 5}/file{i}.txt', b'content %d\n' % i * (i + 1))
+        base.track(['.'], workers=8)
+        index = base.get_index_tree()
+        self.assertEqual(len(index), 50)
+        for path, obj_id in index.items():
+            with open(path, 'rb') as f:
+                self.assertEqual(fingerprint(f.read(), write=False), obj_id)
+            self.assertTrue(object_exists(obj_id))
+        self.assertEqual(base.get_working_tree(workers=1), index)
+
+
+class TestCompare(RepoTestCase):
+
+    def test_unified_diff(self):
+        o_from = fingerprint(b'int main()\n{\n  a;\n  b;\n  c;\n  d;\n  e;\n}')
+        o_to = fingerprint(b'int main()\n{\n  a;\n  b;\n  c;\n  D;\n  e;\n}')
+        self.assertEqual(
+            compare.compare_blobs(o_from, o_to, 'f.c'),
+            b'--- a/f.c\n+++ b/f.c\n@@ -3,6 +3,6 @@ int main()\n'
+            b'   a;\n   b;\n   c;\n-  d;\n+  D;\n   e;\n }\n'
+            b'\\ No newline at end of file\n')
+
+    def test_new_and_binary_files(self):
+        o_new = fingerprint(b'one\ntwo\n')
+        self.assertEqual(compare.compare_blobs(None, o_new, 'n'),
+                         b'--- a/n\n+++ b/n\n@@ -0,0 +1,2 @@\n+one\n+two\n')
+        o_bin = fingerprint(b'\x00\x01')
+        self.assertEqual(compare.compare_blobs(o_new, o_bin, 'b'),
+                         b'Binary files a/b and b/b differ\n')
+
+    def test_process_pool_output_matches(self):
+        t_from = {f'f{i}': fingerprint(b'%d\n' % i) for i in range(20)}
+        t_to = {f'f{i}': fingerprint(b'%d\n' % -i) for i in range(20)}
+        serial = list(compare.comp_trees(compare.compare_trees(t_from, t_to)))
+        min_changes = compare.POOL_MIN_CHANGES
+        compare.POOL_MIN_CHANGES = 1
+        try:
+            pooled = list(compare.comp_trees(
+                compare.compare_trees(t_from, t_to), workers=2))
+        finally:
+            compare.POOL_MIN_CHANGES = min_changes
+        self.assertEqual(pooled, serial)
+        self.assertEqual(len(serial), 19)
+
+
+class TestCombine(RepoTestCase):
+
+    def test_trivial_paths_resolved_by_id(self):
+        o_base, o_new = fingerprint(b'base\n'), fingerprint(b'new\n')
+        count = len(list(files._iter_loose_objects()))
+        tree = compare.combine_trees(compare.compare_trees(
+            {'same': o_base, 'ours': o_base, 'theirs': o_base, 'gone': o_base},
+            {'same': o_base, 'ours': o_new, 'theirs': o_base},
+            {'same': o_base, 'ours': o_base, 'theirs': o_new, 'gone': o_base}))
+        self.assertEqual(tree, {'same': o_base, 'ours': o_new, 'theirs': o_new,
+                                'gone': None})
+        self.assertEqual(len(list(files._iter_loose_objects())), count)
+
+    def test_line_merge(self):
+        base_lines = [b'%d\n' % i for i in range(20)]
+        HEAD, other = list(base_lines), list(base_lines)
+        HEAD[2], other[15] = b'HEAD\n', b'other\n'
+        o_base, o_HEAD, o_other = (fingerprint(b''.join(lines))
+                                   for lines in (base_lines, HEAD, other))
+        merged = list(base_lines)
+        merged[2], merged[15] = b'HEAD\n', b'other\n'
+        self.assertEqual(compare.combine_blobs(o_base, o_HEAD, o_other),
+                         b''.join(merged))
+
+    def test_conflict_markers(self):
+        o_base, o_HEAD, o_other = (fingerprint(data)
+                                   for data in (b'a\nb\n', b'a\nH\n', b'a\nO'))
+        self.assertEqual(
+            compare.combine_blobs(o_base, o_HEAD, o_other),
+            b'a\n<<<<<<< HEAD\nH\n||||||| BASE\nb\n=======\nO\n'
+            b'>>>>>>> COMBINE_HEAD\n')
+
+
+class TestTreeChanges(RepoTestCase):
+
+    def test_changes_match_flat_comparison(self):
+        for i in range(30):
+            self.write(f'd{i % 3}/s{i % 2}/f{i}', b'%d' % i)
+        base.track(['.'])
+        t_from = base.write_tree()
+        self.write('d1/s0/f4', b'changed')
+        self.write('d2/new', b'new')
+        os.remove('d0/s1/f3')
+        base.track(['.'])
+        with files.get_index() as index:
+            del index['d0/s1/f3']
+        t_to = base.write_tree()
+
+        expected = sorted(
+            (path, o_from, o_to) for path, o_from, o_to in compare.compare_trees(
+                base.get_tree(t_from), base.get_tree(t_to)) if o_from != o_to)
+        self.assertEqual(sorted(base.iter_tree_changes(t_from, t_to)), expected)
+        self.assertEqual(
+            sorted(base.iter_tree_changes(t_from, base.get_index_tree())), expected)
+        self.assertEqual(list(base.iter_tree_changes(t_to, t_to)), [])
+
+    def test_unchanged_subtrees_are_not_read(self):
+        for i in range(30):
+            self.write(f'd{i % 3}/s{i % 2}/f{i}', b'%d' % i)
+        base.track(['.'])
+        t_from = base.write_tree()
+        self.write('d1/s0/f4', b'changed')
+        base.track(['d1/s0/f4'])
+        t_to = base.write_tree()
+
+        read = []
+        get_object = files.get_object
+
+        def counting_get_object(obj_id, expected='blob'):
+            read.append(obj_id)
+            return get_object(obj_id, expected)
+
+        files.get_object = counting_get_object
+        try:
+            changes = list(base.iter_tree_changes(t_from, t_to))
+        finally:
+            files.get_object = get_object
+        self.assertEqual([path for path, *_ in changes], ['d1/s0/f4'])
+        self.assertEqual(len(read), 6)
+
+
+class TestCommitGraph(RepoTestCase):
+
+    def make_history(self):
+        # a - b - c
+        #  \
+        #   d - e
+        self.write('f', b'a')
+        base.track(['f'])
+        saves = {'a': base.save('a')}
+        for name in 'bc':
+            self.write('f', name.encode())
+            base.track(['f'])
+            saves[name] = base.save(name)
+        base.reset(saves['a'])
+        for name in 'de':
+            self.write('g', name.encode())
+            base.track(['g'])
+            saves[name] = base.save(name)
+        return saves
+
+    def test_reachable_from(self):
+        saves = self.make_history()
+        has_save = base.reachable_from([saves['c'], saves['d']])
+        reached = {name for name, obj_id in sorted(saves.items(), reverse=True)
+                   if has_save(obj_id)}
+        self.assertEqual(reached, {'a', 'b', 'c', 'd'})
+        self.assertFalse(base.reachable_from([])(saves['a']))
+
+    def test_generations(self):
+        saves = self.make_history()
+        generations = {
+            name: base.get_graph_entry(obj_id).generation
+            for name, obj_id in saves.items()}
+        self.assertEqual(generations, {'a': 1, 'b': 2, 'c': 3, 'd': 2, 'e': 3})
+        self.assertEqual(
+            base.get_graph_entry(saves['c']).tree, base.get_save(saves['c']).tree)
+
+    def test_combine_base_and_ancestry(self):
+        saves = self.make_history()
+        self.assertEqual(base.get_combine_base(saves['c'], saves['e']), saves['a'])
+        self.assertEqual(base.get_combine_base(saves['c'], saves['b']), saves['b'])
+        self.assertTrue(base.is_ancestor_of(saves['c'], saves['a']))
+        self.assertTrue(base.is_ancestor_of(saves['c'], saves['c']))
+        self.assertFalse(base.is_ancestor_of(saves['c'], saves['d']))
+        self.assertFalse(base.is_ancestor_of(saves['a'], saves['c']))
+        self.assertFalse(base.is_ancestor_of(saves['c'], 'f' * 40))
+
+    def test_graph_is_rebuilt_without_reading_saves_twice(self):
+        saves = self.make_history()
+        os.remove(f'{files.GPGIT_DIR}/commit-graph')
+        self.assertEqual(base.get_graph_entry(saves['e']).generation, 3)
+
+        read = []
+        get_save = base.get_save
+
+        def counting_get_save(obj_id):
+            read.append(obj_id)
+            return get_save(obj_id)
+
+        base.get_save = counting_get_save
+        try:
+            history = list(base.iter_saves_and_parents({saves['e']}))
+            self.assertEqual(
+                base.get_combine_base(saves['c'], saves['e']), saves['a'])
+        finally:
+            base.get_save = get_save
+        self.assertEqual(history, [saves['e'], saves['d'], saves['a']])
+        self.assertEqual(sorted(read), sorted([saves['b'], saves['c']]))
+
+    def test_concurrent_appends_to_a_new_graph(self):
+        tree = fingerprint(b'', 'tree')
+        entries = [{'%040x' % (i * 10 + j): graph.GraphEntry(tree, (), 1)
+                    for j in range(10)} for i in range(8)]
+        barrier = threading.Barrier(len(entries))
+
+        def add(new_entries):
+            with files.change_git_dir('.'):
+                barrier.wait()
+                graph.add_entries(new_entries)
+
+        threads = [threading.Thread(target=add, args=(new_entries,))
+                   for new_entries in entries]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for new_entries in entries:
+            for obj_id in new_entries:
+                self.assertEqual(graph.get_entry(obj_id).tree, tree)
+        with open(f'{files.GPGIT_DIR}/commit-graph', 'rb') as f:
+            self.assertEqual(f.read(8), graph._HEADER.pack(graph.SIGNATURE, graph.VERSION))
+            self.assertEqual(f.read().count(graph.SIGNATURE), 0)
+
+
+class TestObjectCache(RepoTestCase):
+
+    def tearDown(self):
+        files.set_cache_size(files.CACHE_SIZE)
+        super().tearDown()
+
+    def test_repeated_reads_hit_the_cache(self):
+        obj_id = files.fingerprint(b'cached')
+        cache = files._object_cache
+        hits, misses = cache.hits, cache.misses
+        self.assertEqual(files.get_object(obj_id), b'cached')
+        os.remove(files._find_loose_object(obj_id))
+        self.assertEqual(files.get_object(obj_id), b'cached')
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (1, 1))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = files.ObjectCache('test', max_size=10)
+        try:
+            cache.put('a', 'a', 4)
+            cache.put('b', 'b', 4)
+            cache.get('a')
+            cache.put('c', 'c', 4)
+            cache.put('d', 'd', 20)
+            self.assertEqual(
+                [cache.get(key) for key in 'abcd'], ['a', None, 'c', None])
+            self.assertEqual(cache.size, 8)
+            cache.resize(0)
+            self.assertEqual((cache.size, cache.get('a')), (0, None))
+        finally:
+            del files._caches['test']
+
+    def test_cache_can_be_turned_off(self):
+        files.set_cache_size(0)
+        obj_id = files.fingerprint(b'uncached')
+        files.get_object(obj_id)
+        os.remove(files._find_loose_object(obj_id))
+        with self.assertRaises(FileNotFoundError):
+            files.get_object(obj_id)
+
+    def test_parsed_saves_are_cached(self):
+        self.write('f', b'f')
+        base.track(['f'])
+        obj_id = base.save('first')
+        self.assertIs(base.get_save(obj_id), base.get_save(obj_id))
+
+
+class TestCacheTree(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(30):
+            self.write(f'd{i % 3}/s{i % 2}/f{i}', b'%d' % i)
+        base.track(['.'])
+
+    def written_trees(self, func):
+        written = []
+        fingerprint = files.fingerprint
+
+        def recording_fingerprint(data, type_='blob', write=True):
+            if type_ == 'tree':
+                written.append(data)
+            return fingerprint(data, type_, write)
+
+        files.fingerprint = recording_fingerprint
+        try:
+            result = func()
+        finally:
+            files.fingerprint = fingerprint
+        return result, written
+
+    def test_only_changed_directories_are_rehashed(self):
+        base.write_tree()
+        self.write('d1/s0/f4', b'changed')
+        base.track(['.'])
+        tree, written = self.written_trees(base.write_tree)
+        # d1/s0, d1 and the root
+        self.assertEqual(len(written), 3)
+        self.assertEqual(tree, base._tree_from_paths(dict(base.get_index_tree())).obj_id)
+
+        _, written = self.written_trees(base.write_tree)
+        self.assertEqual(written, [])
+
+    def test_cache_survives_saves_in_a_row(self):
+        base.write_tree()
+        with files.read_index() as index:
+            cached = dict(index.trees)
+        # The root, three directories and their six subdirectories
+        self.assertEqual(len(cached), 10)
+        for path in ('d1/s0/f4', 'd2/s1/f5'):
+            self.write(path, b'changed')
+            base.track([path])
+            _, written = self.written_trees(lambda: base.save(path))
+            self.assertEqual(len(written), 3)
+            with files.read_index() as index:
+                self.assertEqual(set(index.trees), set(cached))
+                self.assertEqual(index.trees['d0/s1'], cached['d0/s1'])
+
+    def test_removed_paths_invalidate_their_directories(self):
+        base.write_tree()
+        with files.get_index() as index:
+            del index['d2/s1/f5']
+            index.pop('d0/s0/f0')
+        tree, written = self.written_trees(base.write_tree)
+        self.assertEqual(len(written), 5)
+        self.assertNotIn('d2/s1/f5', base.get_tree(tree))
+
+    def test_read_tree_fills_the_cache(self):
+        tree = base.write_tree()
+        self.write('d0/new', b'new')
+        base.track(['.'])
+        base.write_tree()
+        base.read_tree(tree)
+        self.assertEqual(self.written_trees(base.write_tree), (tree, []))
+
+
+class TestRefs(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('f', b'f')
+        base.track(['f'])
+        self.first = base.save('first')
+        self.second = base.save('second')
+        for i in range(5):
+            base.create_label(f'v{i}', self.first)
+
+    def ref(self, value):
+        return files.RefValue(symbolic=False, value=value)
+
+    def test_pack_refs(self):
+        refs = dict(files.iter_refs())
+        self.assertEqual(files.pack_refs(), 6)
+        self.assertFalse(os.path.exists('.gpgit/refs/labels/v0'))
+        self.assertEqual(dict(files.iter_refs()), refs)
+        self.assertEqual(files.get_ref('HEAD').value, self.second)
+
+        files.update_ref('refs/labels/v1', self.ref(self.second))
+        self.assertEqual(files.get_ref('refs/labels/v1').value, self.second)
+        files.delete_ref('refs/labels/v2')
+        self.assertIsNone(files.get_ref('refs/labels/v2').value)
+        self.assertNotIn('refs/labels/v2', dict(files.iter_refs()))
+        self.assertEqual(files.pack_refs(), 1)
+        self.assertEqual(files.get_ref('refs/labels/v1').value, self.second)
+
+    def test_compare_and_swap(self):
+        ref = 'refs/labels/v0'
+        files.update_ref(ref, self.ref(self.second), expected_old=self.first)
+        with self.assertRaises(AssertionError):
+            files.update_ref(ref, self.ref(self.first), expected_old=self.first)
+        with self.assertRaises(AssertionError):
+            files.update_ref(ref, self.ref(self.first), expected_old='')
+        files.update_ref('refs/labels/new', self.ref(self.first), expected_old='')
+        self.assertEqual(files.get_ref(ref).value, self.second)
+        self.assertEqual(
+            [name for name in os.listdir('.gpgit/refs/labels') if '.lock' in name], [])
+
+    def test_locked_ref_is_not_updated(self):
+        open('.gpgit/refs/labels/v0.lock', 'w').close()
+        timeout = files.LOCK_TIMEOUT
+        files.LOCK_TIMEOUT = 0
+        try:
+            with self.assertRaises(AssertionError):
+                files.update_ref('refs/labels/v0', self.ref(self.second))
+        finally:
+            files.LOCK_TIMEOUT = timeout
+        self.assertEqual(files.get_ref('refs/labels/v0').value, self.first)
+        self.assertNotIn('refs/labels/v0.lock', dict(files.iter_refs()))
+
+
+class TestCheckout(RepoTestCase):
+
+    def test_only_changed_paths_are_touched(self):
+        for i in range(10):
+            self.write(f'd/f{i}', b'%d' % i)
+        self.write('gone/f', b'gone')
+        base.track(['.'])
+        first = base.save('first')
+        self.write('d/f1', b'changed')
+        os.remove('gone/f')
+        self.write('new/f', b'new')
+        base.track(['.'])
+        with files.get_index() as index:
+            del index['gone/f']
+        second = base.save('second')
+        self.write('untracked', b'untracked')
+
+        before = os.stat('d/f2')
+        base.read_tree(base.get_save(first).tree, update_working=True)
+        self.assertEqual(os.stat('d/f2').st_mtime_ns, before.st_mtime_ns)
+        self.assertTrue(os.path.exists('untracked'))
+        self.assertFalse(os.path.exists('new'))
+        with open('d/f1', 'rb') as f:
+            self.assertEqual(f.read(), b'1')
+        with open('gone/f', 'rb') as f:
+            self.assertEqual(f.read(), b'gone')
+        with files.read_index() as index:
+            self.assertEqual(index.get_stat('d/f1')[1], files.stat_path('d/f1'))
+
+        base.read_tree(base.get_save(second).tree, update_working=True)
+        self.assertFalse(os.path.exists('gone'))
+        self.assertEqual(
+            base.get_working_tree(),
+            dict(base.get_index_tree(), untracked=fingerprint(b'untracked', write=False)))
+
+
+class TestParallelCheckout(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(40):
+            self.write(f'd{i % 4}/s{i % 3}/f{i}', b'content %d\n' % i * i)
+        base.track(['.'])
+        self.tree = base.write_tree()
+        self.paths = sorted(base.get_index_tree())
+        for path in self.paths:
+            os.remove(path)
+        with files.get_index() as index:
+            index.clear()
+
+    def test_parallel_checkout_with_progress(self):
+        progress = []
+        base.read_tree(
+            self.tree, update_working=True, workers=8,
+            progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress, [(i, 40) for i in range(1, 41)])
+        self.assertEqual(base.get_working_tree(), base.get_tree(self.tree))
+        with files.read_index() as index:
+            for path in self.paths:
+                self.assertEqual(index.get_stat(path)[1], files.stat_path(path))
+
+    def test_first_error_in_path_order_is_raised(self):
+        tree = base.get_tree(self.tree)
+        for path in (self.paths[30], self.paths[3]):
+            os.remove(files._object_path(tree[path]))
+        with self.assertRaisesRegex(FileNotFoundError, tree[self.paths[3]]):
+            base.read_tree(self.tree, update_working=True, workers=8)
+
+
+class TestThrow(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(30):
+            self.write(f'd{i % 3}/s{i % 2}/f{i}', b'%d' % i)
+        base.track(['.'])
+        self.first = base.save('first')
+
+    def test_only_new_objects_are_sent(self):
+        self.write('d1/s0/f4', b'changed')
+        self.write('d2/s1/f5', b'also changed')
+        base.track(['.'])
+        second = base.save('second')
+        self.write('d0/new', b'new')
+        base.track(['.'])
+        third = base.save('third')
+
+        def has_save(obj_id):
+            return obj_id == self.first
+
+        new = list(base.iter_new_objects({third}, has_save))
+        expected = (set(base.iter_objects_in_saves({third}))
+                    - set(base.iter_objects_in_saves({self.first})))
+        self.assertEqual({obj_id for _, obj_id, _ in new}, expected)
+        self.assertEqual(len(new), len(expected))
+        self.assertEqual([obj_id for type_, obj_id, _ in new if type_ == 'save'],
+                         [second, third])
+        self.assertEqual(list(base.iter_new_objects({third}, lambda obj_id: True)), [])
+
+    def test_throw(self):
+        os.makedirs('remote')
+        with files.change_git_dir('remote'):
+            base.start()
+        remote.throw('remote', 'refs/heads/master')
+        self.write('d1/s0/f4', b'changed')
+        base.track(['d1/s0/f4'])
+        second = base.save('second')
+
+        objects = set(base.iter_objects_in_saves({second}))
+        with files.change_git_dir('remote'):
+            before = set(filter(files.object_exists, objects))
+        remote.throw('remote', 'refs/heads/master')
+        # Same filesystem: the blob, d1/s0, d1, the root tree and the save
+        # are hardlinked rather than copied
+        for obj_id in objects - before:
+            with files.change_git_dir('remote'):
+                remote_stat = os.stat(files._find_loose_object(obj_id))
+            local_stat = os.stat(files._find_loose_object(obj_id))
+            self.assertEqual(remote_stat.st_ino, local_stat.st_ino)
+        self.assertEqual(len(objects - before), 5)
+        with files.change_git_dir('remote'):
+            self.assertEqual(files.get_ref('refs/heads/master').value, second)
+            self.assertEqual(
+                sorted(base.iter_objects_in_saves({second})), sorted(
+                    obj_id for obj_id in base.iter_objects_in_saves({second})
+                    if files.object_exists(obj_id)))
+
+    def test_throw_fills_in_an_incomplete_history(self):
+        os.makedirs('remote')
+        with files.change_git_dir('remote'):
+            base.start()
+        remote.throw('remote', 'refs/heads/master')
+        for name in ('second', 'third'):
+            self.write('d0/new', name.encode())
+            base.track(['d0/new'])
+            last = base.save(name)
+        # Left behind without its parent or trees
+        with files.change_git_dir('remote'):
+            objects_dir = f'{files.get_git_dir()}/objects'
+        files._copy_loose_object(files._find_loose_object(last), objects_dir, last)
+
+        remote.throw('remote', 'refs/heads/master')
+        objects = set(base.iter_objects_in_saves({last}))
+        with files.change_git_dir('remote'):
+            self.assertEqual(set(filter(files.object_exists, objects)), objects)
+            self.assertTrue(base.has_full_history(last))
+
+
+class TestTransfer(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(10):
+            self.write(f'd/f{i}', b'%d' % i)
+        base.track(['.'])
+        self.save = base.save('first')
+        self.objects = list(base._iter_typed_objects_in_saves({self.save}))
+        os.makedirs('other')
+        with files.change_git_dir('other'):
+            base.start()
+
+    def assert_has_objects(self, git_dir):
+        with files.change_git_dir(git_dir):
+            for _, obj_id, _ in self.objects:
+                self.assertTrue(files.object_exists(obj_id))
+            self.assertEqual(base.get_tree(base.get_save(self.save).tree)['d/f3'],
+                             fingerprint(b'3', write=False))
+
+    def test_transfer_as_pack(self):
+        name = files.transfer_objects(self.objects, '.', 'other', share=False)
+        with files.change_git_dir('other'):
+            self.assertEqual(
+                sorted(os.listdir(files._pack_dir())), [f'{name}.idx', f'{name}.pack'])
+        self.assert_has_objects('other')
+
+    def test_packs_are_shared_whole(self):
+        name, _ = base.pack_objects(gc=True)
+        files.transfer_objects(self.objects[:1], '.', 'other')
+        with files.change_git_dir('other'):
+            shared = os.stat(f'{files._pack_dir()}/{name}.pack')
+        self.assertEqual(shared.st_ino, os.stat(f'{files._pack_dir()}/{name}.pack').st_ino)
+        self.assert_has_objects('other')
+
+    def test_download(self):
+        self.write('d/f1', b'changed')
+        base.track(['d/f1'])
+        second = base.save('second')
+        base.pack_objects(gc=True)
+        with files.change_git_dir('other'):
+            remote.download('.', jobs=4)
+            self.assertEqual(files.get_ref('refs/remote/master').value, second)
+            for obj_id in base.iter_objects_in_saves({second}):
+                self.assertTrue(files.object_exists(obj_id))
+
+    def test_interrupted_download_is_finished_by_the_next(self):
+        saves = [self.save]
+        for i in range(3):
+            self.write(f'd/f{i}', b'changed %d' % i)
+            self.write(f'e{i}/g', b'new %d' % i)
+            base.track(['.'])
+            saves.append(base.save(f'save {i}'))
+        count = len(list(base.iter_new_objects({saves[-1]}, lambda obj_id: False)))
+        copy_loose_object = files._copy_loose_object
+        lock = threading.Lock()
+
+        for fail_after in range(count):
+            copies = []
+
+            def failing_copy(*args):
+                with lock:
+                    if len(copies) == fail_after:
+                        raise OSError(errno.ENOSPC, 'No space left on device')
+                    copies.append(args)
+                copy_loose_object(*args)
+
+            path = f'local{fail_after}'
+            os.makedirs(path)
+            files._copy_loose_object = failing_copy
+            try:
+                with files.change_git_dir(path):
+                    base.start()
+                    with self.assertRaises(OSError):
+                        remote.download('.', jobs=4)
+            finally:
+                files._copy_loose_object = copy_loose_object
+
+            with files.change_git_dir(path):
+                remote.download('.', jobs=4)
+                self.assertEqual(
+                    list(base.iter_saves_and_parents({saves[-1]})), saves[::-1])
+                for obj_id in base.iter_objects_in_saves({saves[-1]}):
+                    self.assertTrue(files.object_exists(obj_id))
+
+    def test_download_across_filesystems_writes_one_pack(self):
+        same_filesystem = files.same_filesystem
+        files.same_filesystem = lambda from_git_dir, to_git_dir: False
+        try:
+            with files.change_git_dir('other'):
+                remote.download('.')
+                self.assertEqual(len(pack.get_packs(files._pack_dir())), 1)
+                self.assertEqual(
+                    [name for name in os.listdir(f'{files.GPGIT_DIR}/objects')
+                     if name != 'pack'], [])
+        finally:
+            files.same_filesystem = same_filesystem
+        self.assert_has_objects('other')
+
+    def test_shared_download(self):
+        with files.change_git_dir('other'):
+            remote.download('.', shared=True)
+            self.assertEqual(os.listdir(f'{files.GPGIT_DIR}/objects'), ['info'])
+            self.assertEqual(files.get_ref('refs/remote/master').value, self.save)
+        self.assert_has_objects('other')
+
+
+class TestPartialDownload(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.saves = []
+        for i in range(3):
+            self.write('d/f', b'version %d\n' % i)
+            self.write(f'e/g{i}', b'new %d\n' % i)
+            base.track(['.'])
+            self.saves.append(base.save(f'save {i}'))
+        os.makedirs('other')
+        with files.change_git_dir('other'):
+            base.start()
+
+    def test_depth(self):
+        with files.change_git_dir('other'):
+            remote.download('.', depth=2)
+            self.assertEqual(files.get_shallow(), {self.saves[1]})
+            self.assertFalse(files.object_exists(self.saves[0]))
+            self.assertEqual(list(base.iter_saves_and_parents({self.saves[2]})),
+                             self.saves[:0:-1])
+            # The boundary save has its whole tree, not just what changed
+            tree = base.get_tree(base.get_graph_entry(self.saves[1]).tree)
+            self.assertEqual(files.get_object(tree['e/g0']), b'new 0\n')
+
+    def test_full_download_deepens_history(self):
+        with files.change_git_dir('other'):
+            remote.download('.', depth=1)
+            self.assertEqual(files.get_shallow(), {self.saves[2]})
+            self.assertFalse(base.is_ancestor_of(self.saves[2], self.saves[1]))
+            remote.download('.', depth=2)
+            self.assertEqual(files.get_shallow(), {self.saves[1]})
+            self.assertEqual(base.get_graph_entry(self.saves[2]).generation, 2)
+            remote.download('.')
+            self.assertEqual(files.get_shallow(), set())
+            self.assertEqual(list(base.iter_saves_and_parents({self.saves[2]})),
+                             self.saves[::-1])
+            self.assertTrue(base.is_ancestor_of(self.saves[2], self.saves[0]))
+            self.assertEqual(base.get_graph_entry(self.saves[2]).generation, 3)
+            self.assertEqual(base.get_graph_entry(self.saves[1]).parents,
+                             (self.saves[0],))
+
+    def test_shallow_saves_have_no_full_history(self):
+        with files.change_git_dir('other'):
+            remote.download('.', depth=2)
+            base.get_graph_entry(self.saves[2])
+            self.assertFalse(base.has_full_history(self.saves[1]))
+            self.assertFalse(base.has_full_history(self.saves[2]))
+            remote.download('.')
+            self.assertTrue(base.has_full_history(self.saves[2]))
+
+    def test_blob_none_fetches_blobs_when_needed(self):
+        with files.change_git_dir('other'):
+            remote.download('.', filter='blob:none')
+            tree = base.get_tree(base.get_graph_entry(self.saves[2]).tree)
+            for obj_id in base.iter_saves_and_parents({self.saves[2]}):
+                self.assertTrue(files.object_exists(obj_id))
+            for obj_id in tree.values():
+                self.assertFalse(files.object_exists(obj_id))
+            self.assertEqual(files.get_object(tree['d/f']), b'version 2\n')
+
+        fetched = []
+        fetch_objects = files.fetch_objects
+
+        def record(obj_ids):
+            count = fetch_objects(obj_ids)
+            fetched.append(count)
+            return count
+
+        os.chdir('other')
+        files.fetch_objects = record
+        try:
+            with files.change_git_dir('.'):
+                base.read_tree(base.get_graph_entry(self.saves[2]).tree,
+                               update_working=True)
+        finally:
+            files.fetch_objects = fetch_objects
+            os.chdir('..')
+        # All but d/f, fetched above, in one batch
+        self.assertEqual(fetched, [3])
+        with open('other/e/g0', 'rb') as f:
+            self.assertEqual(f.read(), b'new 0\n')
+
+    def test_gc_leaves_blobs_on_promisor(self):
+        with files.change_git_dir('other'):
+            remote.download('.', filter='blob:none')
+            _, count = base.pack_objects(gc=True)
+            # Three saves, their root trees and three versions of d and e
+            self.assertEqual(count, 3 + 3 + 3 + 3)
+
+
+class TestTransferEngine(unittest.TestCase):
+
+    def test_bounded_concurrency_and_progress(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0}
+
+        def job():
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        progress = []
+        done = transfer.run(
+            (job for _ in range(20)), max_in_flight=4,
+            progress=lambda done, started: progress.append(done))
+        self.assertEqual(done, 20)
+        self.assertEqual(state['most'], 4)
+        self.assertEqual(progress, list(range(1, 21)))
+
+    def test_transient_errors_are_retried(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OSError(errno.EIO, 'flaky')
+
+        delay = transfer.RETRY_DELAY
+        transfer.RETRY_DELAY = 0
+        try:
+            self.assertEqual(transfer.run([flaky]), 1)
+            self.assertEqual(len(attempts), 3)
+
+            def missing():
+                attempts.append(1)
+                raise FileNotFoundError(errno.ENOENT, 'missing')
+
+            attempts.clear()
+            closed = []
+
+            def jobs():
+                try:
+                    yield missing
+                    yield missing
+                finally:
+                    closed.append(True)
+
+            with self.assertRaises(FileNotFoundError):
+                transfer.run(jobs(), max_in_flight=1)
+            self.assertEqual((len(attempts), closed), (1, [True]))
+        finally:
+            transfer.RETRY_DELAY = delay
+
+
+class TestBundle(RepoTestCase):
+
+    def test_bundle_round_trip(self):
+        for i in range(10):
+            self.write(f'd/f{i}', b'line\n' * 50 + b'%d\n' % i)
+        base.track(['.'])
+        first = base.save('first')
+        base.create_branch('other', first)
+        self.write('d/f1', b'changed')
+        base.track(['d/f1'])
+        second = base.save('second')
+
+        refs, count = remote.create_bundle(
+            'all.bundle', ['refs/heads/master', 'refs/heads/other'])
+        self.assertEqual(count, len(set(base.iter_objects_in_saves({second}))))
+
+        os.makedirs('clone')
+        with files.change_git_dir('clone'):
+            base.start()
+            self.assertEqual(remote.unbundle('all.bundle'), {
+                'refs/heads/master': second, 'refs/heads/other': first})
+            for obj_id in base.iter_objects_in_saves({second}):
+                self.assertTrue(files.object_exists(obj_id))
+            self.assertEqual(base.get_tree(base.get_save(second).tree)['d/f1'],
+                             fingerprint(b'changed', write=False))
+
+    def test_corrupt_bundle_is_rejected(self):
+        self.write('f', b'f')
+        base.track(['f'])
+        base.save('first')
+        remote.create_bundle('bad.bundle', ['refs/heads/master'], deltas=False)
+        with open('bad.bundle', 'r+b') as f:
+            f.seek(-30, os.SEEK_END)
+            f.write(b'x')
+        with self.assertRaisesRegex(AssertionError, 'Corrupt pack'):
+            remote.unbundle('bad.bundle')
+        self.assertEqual(os.listdir(files._pack_dir()), [])
+
+
+class TestRepository(RepoTestCase):
+
+    def test_threads_work_on_their_own_repositories(self):
+        repos = [Repository(name) for name in ('a', 'b')]
+        for repo in repos:
+            os.makedirs(repo.path)
+            repo.start()
+        errors = []
+
+        def work(repo, other):
+            try:
+                for i in range(50):
+                    obj_id = repo.fingerprint(b'%s %d' % (repo.path.encode(), i))
+                    repo.update_ref('refs/heads/master',
+                                    files.RefValue(symbolic=False, value=obj_id))
+                    assert repo.object_exists(obj_id)
+                    assert not other.object_exists(obj_id)
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(repos[0], repos[1])),
+                   threading.Thread(target=work, args=(repos[1], repos[0]))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for repo in repos:
+            self.assertEqual(repo.get_object(repo.get_ref('HEAD').value),
+                             b'%s 49' % repo.path.encode())
+        self.assertEqual(files.GPGIT_DIR, './.gpgit')
+
+    def test_change_git_dir_stays_in_its_thread(self):
+        entered = threading.Event()
+        done = threading.Event()
+
+        def other_thread():
+            with files.change_git_dir('elsewhere'):
+                entered.set()
+                done.wait()
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        entered.wait()
+        self.assertEqual(files.get_git_dir(), './.gpgit')
+        done.set()
+        thread.join()
+
+    def test_generator_methods(self):
+        self.write('f', b'f')
+        base.track(['f'])
+        first = base.save('first')
+        os.makedirs('other')
+        other = Repository('other')
+        other.start()
+        remote.create_bundle('all.bundle', ['refs/heads/master'])
+        with other.current():
+            remote.unbundle('all.bundle')
+            base.create_branch('copy', first)
+        # Iterated while this test's repository is the current one
+        refs = other.iter_refs('refs/heads/')
+        self.assertEqual(next(refs)[0], 'refs/heads/copy')
+        self.assertEqual(list(base.iter_branch_names()), ['master'])
+        self.assertEqual(list(other.iter_saves_and_parents({first})), [first])
+
+    def test_working_tree_commands_are_left_out(self):
+        for name in ('track', 'read_tree', 'switch', 'combine', 'comp_trees'):
+            self.assertFalse(hasattr(Repository, name))
+
+    def test_close_drops_only_its_own_caches(self):
+        repos = [Repository(name) for name in ('a', 'b')]
+        for repo in repos:
+            os.makedirs(repo.path)
+            repo.start()
+            obj_id = repo.fingerprint(b'shared content')
+            repo.get_object(obj_id)
+            save = repo.save('first')
+            repo.get_save(save)
+            repo.is_ancestor_of(save, save)
+
+        def cached(repo):
+            key = os.path.abspath(repo.git_dir)
+            return sum(
+                any(os.path.abspath(entry[1]) == key for entry in cache._entries)
+                for cache in files._caches.values())
+
+        self.assertEqual([cached(repo) for repo in repos], [2, 2])
+        repos[0].close()
+        self.assertEqual([cached(repo) for repo in repos], [0, 2])
+        self.assertNotIn(os.path.abspath('a/.gpgit/commit-graph'), graph._graphs)
+        self.assertIn(os.path.abspath('b/.gpgit/commit-graph'), graph._graphs)
+        self.assertEqual(repos[0].get_object(obj_id), b'shared content')
+
+    def test_close_leaves_packs_open_for_their_readers(self):
+        repo = Repository('.')
+        self.write('a.txt', b'packed content')
+        base.track(['a.txt'])
+        repo.save('first')
+        obj_id = base.get_index_tree()['a.txt']
+        repo.pack_objects(gc=True)
+        found, offset = pack.find_object('.gpgit/objects/pack', obj_id)
+        repo.close()
+        self.assertEqual(found.read(offset), ('blob', b'packed content'))
+        self.assertIsNot(pack.find_object('.gpgit/objects/pack', obj_id)[0], found)
+
+
+class TestServe(RepoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('d/f', b'first\n')
+        self.write('e/g', b'other\n')
+        base.track(['.'])
+        self.save = base.save('first')
+        for name in ('other', 'third'):
+            os.makedirs(name)
+            with files.change_git_dir(name):
+                base.start()
+        # The server runs in its own process, since it keeps its own
+        # GPGIT_DIR for as long as it serves
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        self.server = subprocess.Popen(
+            [sys.executable, '-c', 'from gpgit import gpgit; gpgit.main()',
+             'serve', '--socket', f'{self.tmp.name}/serve.sock'],
+            cwd='other', stdout=subprocess.PIPE,
+            env=dict(os.environ, PYTHONPATH=root))
+        self.url = self.server.stdout.readline().decode().split()[-1]
+
+    def tearDown(self):
+        protocol.close_connections()
+        self.server.terminate()
+        self.server.wait()
+        self.server.stdout.close()
+        super().tearDown()
+
+    def test_throw_and_download(self):
+        self.assertEqual(self.url, f'gpgit://{self.tmp.name}/serve.sock')
+        remote.throw(self.url, 'refs/heads/master')
+        with files.change_git_dir('other'):
+            self.assertEqual(files.get_ref('refs/heads/master').value, self.save)
+            for obj_id in base.iter_objects_in_saves({self.save}):
+                self.assertTrue(files.object_exists(obj_id))
+
+        with files.change_git_dir('third'):
+            remote.download(self.url)
+            self.assertEqual(files.get_ref('refs/remote/master').value, self.save)
+            self.assertEqual(
+                base.get_tree(base.get_save(self.save).tree)['d/f'],
+                fingerprint(b'first\n', write=False))
+        # Every request went over the same connection
+        self.assertEqual(list(protocol._connections), [self.url])
+
+    def test_download_sends_only_what_its_tips_miss(self):
+        remote.throw(self.url, 'refs/heads/master')
+        with files.change_git_dir('third'):
+            remote.download(self.url)
+        self.write('d/f', b'second\n')
+        base.track(['d/f'])
+        second = base.save('second')
+        remote.throw(self.url, 'refs/heads/master')
+        with files.change_git_dir('third'):
+            remote.download(self.url)
+            self.assertEqual(files.get_ref('refs/remote/master').value, second)
+            # The save, the root tree, d and d/f
+            counts = sorted(packed.count
+                            for packed in pack.get_packs(files._pack_dir()))
+            self.assertEqual(counts, [4, 6])
+
+    def test_refs_are_reread_after_a_change(self):
+        self.assertEqual(protocol.get_refs(self.url, 'refs/heads/'), {})
+        with files.change_git_dir('other'):
+            files.update_ref('refs/heads/direct',
+                             files.RefValue(symbolic=False, value=self.save))
+        self.assertEqual(protocol.get_refs(self.url, 'refs/heads/'),
+                         {'refs/heads/direct': self.save})
+
+    def test_partial_download_fetches_blobs_from_server(self):
+        self.write('d/f', b'second\n')
+        base.track(['d/f'])
+        second = base.save('second')
+        remote.throw(self.url, 'refs/heads/master')
+        with files.change_git_dir('third'):
+            remote.download(self.url, depth=1, filter='blob:none')
+            self.assertEqual(files.get_shallow(), {second})
+            tree = base.get_tree(base.get_graph_entry(second).tree)
+            self.assertFalse(files.object_exists(tree['d/f']))
+            self.assertEqual(files.get_object(tree['d/f']), b'second\n')
+            self.assertFalse(files.object_exists(self.save))
+            remote.download(self.url)
+            self.assertEqual(files.get_shallow(), set())
+            self.assertEqual(list(base.iter_saves_and_parents({second})),
+                             [second, self.save])
+
+    def test_moved_ref_is_refused(self):
+        remote.throw(self.url, 'refs/heads/master')
+        with self.assertRaisesRegex(AssertionError, 'moved'):
+            protocol.push(self.url, 'refs/heads/master', None, self.save,
+                          lambda out: None)
+        # An error ends the request, not the connection
+        self.assertEqual(protocol.get_refs(self.url, 'refs/heads/'),
+                         {'refs/heads/master': self.save})
+
+    def test_push_outside_branches_is_refused(self):
+        for refname in ('../../outside-the-repo', 'refs/heads/../../../outside',
+                        f'{self.tmp.name}/outside', 'HEAD', 'refs/labels/v1',
+                        'refs/heads/', 'refs/heads//x', 'refs/heads/x.lock'):
+            with self.assertRaisesRegex(AssertionError, 'Invalid branch name'):
+                protocol.push(self.url, refname, None, self.save, lambda out: None)
+        for name in ('outside-the-repo', 'outside'):
+            self.assertFalse(os.path.exists(f'{self.tmp.name}/{name}'))
+        self.assertFalse(os.path.exists('other/.gpgit/refs'))
+        remote.throw(self.url, 'refs/heads/master')
+        self.assertEqual(protocol.get_refs(self.url, 'refs/heads/'),
+                         {'refs/heads/master': self.save})
+
+
+class TestStartup(RepoTestCase):
+
+    def test_plumbing_skips_slow_imports(self):
+        self.write('f', b'f')
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        code = ("import sys; from gpgit import gpgit; "
+                "sys.argv = ['gp-git', 'fingerprint', 'f']; gpgit.main(); "
+                "print([name for name in ('asyncio', 'socket', 'concurrent.futures', "
+                "'gpgit.base', 'gpgit.remote') if name in sys.modules])")
+        output = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, check=True,
+            env=dict(os.environ, PYTHONPATH=root)).stdout.decode().split('\n')
+        self.assertEqual(output[:2], [fingerprint(b'f', write=False), '[]'])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file